@@ -0,0 +1,331 @@
+#! /usr/bin/env python
+
+import hashlib
+import threading
+from collections import OrderedDict
+import numpy as np
+
+
+# Bits written in front of each payload kind: text length, binary length, image width and height
+HEADER_BITS = {'text': 16, 'binary': 64, 'image': 32}
+MAX_TEXT = 65535  # text length is coded on 16 bits
+ORDER_CACHE_BYTES = 64 * 1024 * 1024  # memory held by the cached keyed slot orders
+
+
+class SteganographyException(Exception):
+    pass
+
+
+def capacity_bits(shape, bits=0):
+    # Bits a carrier of this shape can hold. bits=0 is the default layout, every slot of
+    # bit-plane 0 then every slot of plane 1 and so on, which can not use the very last
+    # slot. bits=k puts k bits in every slot at once and only touches the k low planes.
+    slots = int(np.prod(shape))
+    if bits:
+        return slots * bits
+    return 8 * slots - 1
+
+
+def max_payload(shape, kind='text', bits=0):  # Largest payload in bytes, header excluded
+    n = max(0, (capacity_bits(shape, bits) - HEADER_BITS[kind]) // 8)
+    return min(n, MAX_TEXT) if kind == 'text' else n
+
+
+def fits(shape, nbytes, kind='text', bits=0):  # Cheap check before any pixel is touched
+    return nbytes <= max_payload(shape, kind, bits)
+
+
+def slot_order(key, shape):
+    # Slots of a carrier of this shape in the order a key visits them, the same on every
+    # machine: RandomState streams never change across NumPy versions
+    words = np.frombuffer(hashlib.sha256(key + repr(tuple(shape)).encode('ascii')).digest(), dtype=np.uint32)
+    slots = int(np.prod(shape))
+    return np.random.RandomState(words).permutation(slots).astype(np.int32 if slots < 2 ** 31 else np.int64)
+
+
+class OrderCache:
+    # Keyed slot orders, least recently used first, evicted past max_bytes. Two peers
+    # exchanging messages on the same carrier compute its order once.
+
+    def __init__(self, max_bytes=ORDER_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.orders = OrderedDict()  # read-only index array, indexed by (key, shape)
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, shape):
+        entry = (key, tuple(shape))
+        with self.lock:
+            order = self.orders.get(entry)
+            if order is not None:
+                self.orders.move_to_end(entry)
+                self.hits += 1
+                return order
+            self.misses += 1
+        order = slot_order(key, shape)  # outside the lock, other carriers need not wait for it
+        order.flags.writeable = False
+        with self.lock:
+            if entry not in self.orders:
+                self.orders[entry] = order
+                self.bytes += order.nbytes
+            while self.bytes > self.max_bytes and len(self.orders) > 1:
+                self.bytes -= self.orders.popitem(last=False)[1].nbytes
+        return order
+
+    def stats(self):
+        with self.lock:
+            return {'orders': len(self.orders), 'bytes': self.bytes, 'hits': self.hits, 'misses': self.misses}
+
+
+ORDERS = OrderCache()
+
+
+class LSBSteg():
+    def __init__(self, im, bits=0, key=None):
+        # bits: LSBs used in every channel at once, 0 for the default plane by plane layout
+        # key: bytes shared with the other side, scatters the payload over the slots in an
+        # order only the key gives instead of row after row
+        self.image = im
+        self.height, self.width, self.nbchannels = im.shape
+        self.size = self.width * self.height
+        self.slots = self.size * self.nbchannels  # Slots available in one bit-plane
+        if not 0 <= bits <= 8:
+            raise SteganographyException("bits per channel must be between 0 and 8")
+        self.bits = bits
+        self.pos = 0  # cursor in bits when bits > 0
+        self.order = ORDERS.get(key, im.shape) if key else None  # slot visited at each cursor slot
+
+        self.maskONEValues = [1, 2, 4, 8, 16, 32, 64, 128]
+        # Mask used to put one ex:1->00000001, 2->00000010 .. associated with OR bitwise
+        # Will be used to do bitwise operations
+        self.maskONE = self.maskONEValues.pop(0)
+
+        self.maskZEROValues = [254, 253, 251, 247, 239, 223, 191, 127]
+        # Mak used to put zero ex:254->11111110, 253->11111101 .. associated with AND bitwise
+        self.maskZERO = self.maskZEROValues.pop(0)
+
+        self.curwidth = 0  # Current width position
+        self.curheight = 0  # Current height position
+        self.curchan = 0   # Current channel position
+
+    def tell(self):  # Cursor as an absolute slot index, bit-plane major then row/column/channel
+        if self.bits:
+            return self.pos  # bit index, slot major
+        plane = self.maskONE.bit_length() - 1
+        return plane * self.slots + (self.curheight * self.width + self.curwidth) * self.nbchannels + self.curchan
+
+    def seek(self, pos):  # Move the cursor to an absolute slot index, the inverse of tell()
+        if self.bits:
+            self.pos = pos
+            return
+        plane, idx = divmod(pos, self.slots)
+        self.curheight, rem = divmod(idx, self.width * self.nbchannels)
+        self.curwidth, self.curchan = divmod(rem, self.nbchannels)
+        self.maskONEValues = [1 << p for p in range(plane + 1, 8)]
+        self.maskZEROValues = [255 ^ m for m in self.maskONEValues]
+        self.maskONE = 1 << plane
+        self.maskZERO = 255 ^ self.maskONE
+
+    def _flat(self):  # Flattened carrier in (h, w, chan) order, a view when possible
+        return self.image.reshape(-1)
+
+    def _index(self, first, last):  # Carrier slots of cursor slots first..last-1, an index into _flat()
+        if self.order is None:
+            return slice(first, last)
+        return self.order[first:last]
+
+    def capacity(self, kind='text'):  # Largest payload of this kind the carrier can take
+        return max_payload(self.image.shape, kind, self.bits)
+
+    def _check_fits(self, nbytes, kind):  # Refuse before encoding, not half way through
+        if self.tell() + HEADER_BITS[kind] + 8 * nbytes > capacity_bits(self.image.shape, self.bits):
+            raise SteganographyException(
+                "Carrier image not big enough to hold all the datas to steganography")
+
+    def _check_room(self, start, nb):
+        if self.bits:
+            if start + nb > self.slots * self.bits:
+                raise SteganographyException(
+                    "No available slot remaining (image filled)")
+            return
+        # next_slot() raises once the cursor moves past the last slot of the last plane,
+        # which also happens right after the very last slot has been used
+        if start + nb >= 8 * self.slots:
+            raise SteganographyException(
+                "No available slot remaining (image filled)")
+
+    def _slot_bits(self, flat, first, last):  # k low bits of slots first..last-1, MSB first, as a flat 0/1 array
+        return np.unpackbits(flat[self._index(first, last), None], axis=1)[:, 8 - self.bits:].reshape(-1)
+
+    def _put_kbits(self, bits):  # put_bits() when every slot holds self.bits bits
+        flat = self._flat()
+        k = self.bits
+        first, last = self.pos // k, -(-(self.pos + bits.size) // k)
+        merged = self._slot_bits(flat, first, last)  # keeps the bits of partly written slots
+        off = self.pos - first * k
+        merged[off:off + bits.size] = bits
+        padded = np.zeros((last - first, 8), dtype=np.uint8)
+        padded[:, 8 - k:] = merged.reshape(-1, k)
+        values = np.packbits(padded, axis=1).reshape(-1)
+        index = self._index(first, last)
+        flat[index] = (flat[index] & flat.dtype.type(255 ^ ((1 << k) - 1))) | values
+        if not np.shares_memory(flat, self.image):
+            self.image[...] = flat.reshape(self.image.shape)
+        self.pos += bits.size
+
+    def put_bits(self, bits):  # Put an array of 0/1 values in the image, one bit-plane segment at a time
+        bits = np.asarray(bits, dtype=np.uint8)
+        start = self.tell()
+        self._check_room(start, bits.size)
+        if self.bits:
+            self._put_kbits(bits)
+            return
+        flat = self._flat()
+        pos, i = start, 0
+        while i < bits.size:
+            plane, off = divmod(pos, self.slots)
+            n = min(self.slots - off, bits.size - i)
+            index = self._index(off, off + n)
+            flat[index] = ((flat[index] & flat.dtype.type(255 ^ (1 << plane)))  # AND with maskZERO
+                           | (bits[i:i + n].astype(flat.dtype) << plane))  # OR with maskONE
+            pos += n
+            i += n
+        if not np.shares_memory(flat, self.image):  # Non contiguous carrier, reshape() made a copy
+            self.image[...] = flat.reshape(self.image.shape)
+        self.seek(pos)
+
+    def get_bits(self, nb):  # Read nb bits from the image as an array of 0/1 values
+        start = self.tell()
+        self._check_room(start, nb)
+        flat = self._flat()
+        if self.bits:
+            first = start // self.bits
+            out = self._slot_bits(flat, first, -(-(start + nb) // self.bits))
+            off = start - first * self.bits
+            self.pos += nb
+            return out[off:off + nb]
+        out = np.empty(nb, dtype=np.uint8)
+        pos, i = start, 0
+        while i < nb:
+            plane, off = divmod(pos, self.slots)
+            n = min(self.slots - off, nb - i)
+            out[i:i + n] = (flat[self._index(off, off + n)] >> plane) & 1
+            pos += n
+            i += n
+        self.seek(pos)
+        return out
+
+    def put_bytes(self, data):  # Put every byte of data, most significant bit first
+        self.put_bits(np.unpackbits(np.frombuffer(bytes(data), dtype=np.uint8)))
+
+    def get_bytes(self, nb):
+        return np.packbits(self.get_bits(nb * 8)).tobytes()
+
+    def put_binary_value(self, bits):  # Put the bits in the image
+        self.put_bits(np.frombuffer(bits.encode('ascii'), dtype=np.uint8) - ord('0'))
+
+    def next_slot(self):  # Move to the next slot were information can be taken or put
+        if self.curchan == self.nbchannels-1:  # Next Space is the following channel
+            self.curchan = 0
+            if self.curwidth == self.width-1:  # Or the first channel of the next pixel of the same line
+                self.curwidth = 0
+                if self.curheight == self.height-1:  # Or the first channel of the first pixel of the next line
+                    self.curheight = 0
+                    if self.maskONE == 128:  # Mask 1000000, so the last mask
+                        raise SteganographyException(
+                            "No available slot remaining (image filled)")
+                    else:  # Or instead of using the first bit start using the second and so on..
+                        self.maskONE = self.maskONEValues.pop(0)
+                        self.maskZERO = self.maskZEROValues.pop(0)
+                else:
+                    self.curheight += 1
+            else:
+                self.curwidth += 1
+        else:
+            self.curchan += 1
+
+    def read_bit(self):  # Read a single bit int the image
+        val = self.image[self.curheight, self.curwidth][self.curchan]
+        val = int(val) & self.maskONE
+        self.next_slot()
+        if val > 0:
+            return "1"
+        else:
+            return "0"
+
+    def read_byte(self):
+        return self.read_bits(8)
+
+    def read_bits(self, nb):  # Read the given number of bits
+        return (self.get_bits(nb) + ord('0')).tobytes().decode('ascii')
+
+    def read_int(self, bitsize):  # Read an unsigned big endian int coded on bitsize bits
+        return int.from_bytes(self.get_bytes(bitsize // 8), 'big')
+
+    def byteValue(self, val):
+        return self.binary_value(val, 8)
+
+    def binary_value(self, val, bitsize):  # Return the binary value of an int as a byte
+        binval = bin(val)[2:]
+        if len(binval) > bitsize:
+            raise SteganographyException(
+                "binary value larger than the expected size")
+        while len(binval) < bitsize:
+            binval = "0"+binval
+        return binval
+
+    def int_bytes(self, val, bitsize):  # Same as binary_value but packed, bitsize is a multiple of 8
+        if val >= 1 << bitsize:
+            raise SteganographyException(
+                "binary value larger than the expected size")
+        return val.to_bytes(bitsize // 8, 'big')
+
+    def encode_text(self, txt):
+        try:
+            data = txt.encode('latin-1')  # One byte per char, like ord(char) coded on 8 bits
+        except UnicodeEncodeError:
+            raise SteganographyException(
+                "binary value larger than the expected size")
+        self._check_fits(len(data), 'text')
+        # Length coded on 2 bytes so the text size can be up to 65536 bytes long
+        self.put_bytes(self.int_bytes(len(data), 16) + data)
+        return self.image
+
+    def decode_text(self):
+        l = self.read_int(16)  # Read the text size in bytes
+        return self.get_bytes(l).decode('latin-1')
+
+    def encode_image(self, imtohide):
+        # Hide an uint8 image of shape (height, width, 3), or (height, width) for grayscale which
+        # comes back with 3 identical channels. Every pixel byte goes in one bulk put_bytes().
+        imtohide = np.asarray(imtohide)
+        if imtohide.ndim == 2:
+            imtohide = np.repeat(imtohide[:, :, None], 3, axis=2)
+        if imtohide.dtype != np.uint8 or imtohide.ndim != 3 or imtohide.shape[2] != 3:
+            raise SteganographyException("Only 8 bit images with 1 or 3 channels can be hidden")
+        h, w = imtohide.shape[:2]
+        self._check_fits(imtohide.size, 'image')
+        # Width and height coded on 2 bytes each so up to 65535 pixels
+        self.put_bytes(self.int_bytes(w, 16) + self.int_bytes(h, 16) + imtohide.tobytes())
+        return self.image
+
+    def decode_image(self):
+        width = self.read_int(16)
+        height = self.read_int(16)
+        nbytes = width * height * 3
+        if self.tell() + 8 * nbytes > capacity_bits(self.image.shape, self.bits):  # no image in this carrier
+            raise SteganographyException("Hidden image larger than the carrier, nothing to decode")
+        return np.frombuffer(self.get_bytes(nbytes), dtype=np.uint8).reshape(height, width, 3).copy()
+
+    def encode_binary(self, data):
+        if isinstance(data, str):  # Compat py2/py3
+            data = data.encode('latin-1')
+        self._check_fits(len(data), 'binary')
+        self.put_bytes(self.int_bytes(len(data), 64) + bytes(data))
+        return self.image
+
+    def decode_binary(self):
+        l = self.read_int(64)
+        return self.get_bytes(l)
@@ -1,316 +1,770 @@
 #! /usr/bin/env python
 
+import hashlib
+import os
 import socket
 import sys
 import time
 import threading
-import select
 import traceback
-import numpy as np
-import pickle
-import random
+import tempfile
 import cv2
 import Crypto.Hash.MD5 as MD5
 import atexit
-from collections import defaultdict
+import concurrent.futures
+from collections import deque, OrderedDict
+from concurrent.futures import Future
+import LSBSteg as steg
+from LSBSteg import LSBSteg, SteganographyException
+from carriers import CarrierCache
+import carrier_codecs
+import filetransfer
+import eventloop
+import protocol
+import sessions
+import stegpool
+import tracing
+from protocol import Msg
 
 USERNAME = ''
 LISTENER_SOCK = None
 LISTENING_PORT = 0
-SERVER_SOCKET = None
-INPUTS = []  # readable sockets
-OUTPUTS = []  # writetable sockets
-MSGS = defaultdict(list)  # messages to be sent (queue), indexed by socket
+LOCAL_SOCK = None  # listener for the clients on this host, a Unix domain socket
+LOCAL_PATH = None  # its path, advertised to the server along with LISTENING_PORT
+SERVER_CONN = None  # eventloop.Connection to the chat server
+LOOP = eventloop.EventLoop()  # every socket of the client lives on this loop
+PENDING = deque()  # futures of the requests waiting for an OK/FAIL from the server, oldest first
 logged_in_users = {}  # ports, indexed by username
-sockets = {}  # sockets, indexed by username
+local_addresses = {}  # {'host', 'path'} of the Unix socket of the users that have one, indexed by username
+PRESENCE_SEQ = 0  # sequence number of the last presence snapshot or delta applied to logged_in_users
+SNAPSHOT_PENDING = False  # a JOIN/LEAVE went missing, a full user list was asked for
 ServerPort = 5535
 AUTH_STATUS = 'FAIL'
+AUTH_TIMEOUT = 10  # seconds to wait for the server to answer a login/sign up
+CARRIER_PATH = 'guc1.png'
+STEG_BITS = 0  # LSBs used per channel, 0 fills bit-plane after bit-plane, higher hides more in fewer pixels
+STEG_KEY = os.environ.get('STEG_KEY', '')  # passphrase shared with the peers, scatters what we hide over the carrier
+CARRIERS = CarrierCache()  # decoded carriers, loaded once in Client.init
+PEER_TIMEOUT = 5  # seconds for a peer to accept our connection and answer its HELLO
+DELIVERY_TIMEOUT = 10  # seconds an AMSG waits for the slowest peer before reporting it
+CODEC_PREFERENCE = carrier_codecs.available()  # carrier encodings we accept, most preferred first
+FILE_WINDOW = 4  # FILE chunks in flight at once, this many carriers is all a transfer keeps in memory
+MAX_IDLE_PEERS = 32  # idle peer connections kept open, least recently used ones are closed first
+USE_RELAY = True  # hand messages a peer could not take to the server, which forwards them or keeps them until the peer logs in
+RELAY_CODEC = 'zlib'  # the recipient is unknown when relaying, every client can read zlib
+ENCRYPT = True  # agree on a session key with every peer and encrypt what we hide for them
+USE_LOCAL = hasattr(socket, 'AF_UNIX')  # reach the peers on this host over a Unix domain socket instead of TCP
+LOCAL_CODECS = [carrier_codecs.RawCodec.name] + CODEC_PREFERENCE  # nothing to gain compressing carriers that never leave the host
+KEYS = sessions.SessionCache()  # session keys of the peers, indexed by username
 
 
-class SteganographyException(Exception):
-    pass
+class Server(threading.Thread):
+    # Runs the event loop: our listener, the connection to the chat server and the
+    # connections we opened to other clients all get their frames handled here
 
+    sock = None
 
-class LSBSteg():
-    def __init__(self, im):
-        self.image = im
-        self.height, self.width, self.nbchannels = im.shape
-        self.size = self.width * self.height
+    def init(self, sock, local_sock=None):
+        self.sock = sock
+        LOOP.listen(sock, self.accept)
+        if local_sock is not None:
+            LOOP.listen(local_sock, self.accept)
+
+    def accept(self, sockfd, addr):
+        eventloop.Connection(LOOP, sockfd, self.handle)
+
+    def handle(self, conn, frame_type, payload):
+        global logged_in_users, local_addresses, AUTH_STATUS, PRESENCE_SEQ, SNAPSHOT_PENDING
+        try:
+            # decode here with own private key
+            received = tracing.clock()
+            decoded_msg = payload
+            msg_data = protocol.unpack(decoded_msg)
+            trace = msg_data.trace
+            if trace is not None:
+                tracing.stamp(trace, 'received', received)
+                tracing.stamp(trace, 'unpickled')
+            msg_content = msg_data.msg  # decode here with socket's public key then with steganography
+            type = msg_data.type.strip()
+            if type in REVEALED:  # the steganography runs on STEGS, shown in the order the sender sent
+                method, show = REVEALED[type]
+                STEGS.submit(msg_data.name, reveal, (msg_data, method), revealed(msg_data, show), conn)
+            elif type == 'HELLO':  # a peer opened a connection, pick the carrier codec
+                reply = Msg()
+                reply.type = 'HELLO'
+                reply.name = USERNAME
+                preference = LOCAL_CODECS if conn.sock.family != socket.AF_INET else CODEC_PREFERENCE
+                reply.msg = {'codec': carrier_codecs.negotiate(msg_content.get('codecs', []), preference),
+                             'carriers': CARRIERS.ids()}  # these can be sent as deltas
+                if ENCRYPT and 'dh' in msg_content:  # our half of the key exchange, the session starts now
+                    handshake = sessions.Handshake()
+                    KEYS.put(msg_data.name, handshake.finish(msg_content['dh'], False))
+                    reply.msg['dh'] = handshake.public
+                conn.send(protocol.pack(reply))
+            elif type == 'ULST':
+                if msg_data.seq >= PRESENCE_SEQ:  # an older snapshot would undo deltas already applied
+                    forget_departed(logged_in_users, msg_content)
+                    logged_in_users = msg_content
+                    local_addresses = msg_data.local or {}
+                    PRESENCE_SEQ = msg_data.seq
+                    SNAPSHOT_PENDING = False
+                    PEERS.update(logged_in_users)
+                print('USERLIST UPDATED')
+            elif type == 'JOIN' or type == 'LEAVE':
+                presence(msg_data)
+            elif type == 'STATS':  # answer to our STAT request
+                resolve(msg_data)
+            elif type == 'RACK' or type == 'RNAK':  # the server took or refused a relayed message
+                if type == 'RACK':
+                    print(msg_content)
+                resolve(msg_data)
+            elif type == 'OK':
+                AUTH_STATUS = 'OK'
+                print(msg_content)
+                resolve(msg_data)
+            elif type == 'FAIL':
+                AUTH_STATUS = 'FAIL'
+                print(msg_content)
+                resolve(msg_data)
+            # elif msg_data.type == 'BYE':
+                # do stuff
+            else:
+                print('UNKNOWN MESSAGE TYPE RECEIVED',
+                      msg_data.type)
+        except (protocol.CarrierMissing, sessions.SessionError) as e:
+            print('COULD NOT DECODE MESSAGE:', e)
+        except:
+            traceback.print_exc()
 
-        self.maskONEValues = [1, 2, 4, 8, 16, 32, 64, 128]
-        # Mask used to put one ex:1->00000001, 2->00000010 .. associated with OR bitwise
-        # Will be used to do bitwise operations
-        self.maskONE = self.maskONEValues.pop(0)
+    def run(self):
+        LOOP.run_forever()
+
+
+def steg_key(sender):
+    # Slot order key of the messages of sender, None when not scattering. Every sender
+    # scatters differently, and LSBSteg caches the order of each one it talks with.
+    if not STEG_KEY:
+        return None
+    return hashlib.sha256((STEG_KEY + '\0' + sender).encode('utf-8')).digest()
+
+
+def reveal(msg, method):  # On a STEGS worker: rebuild the carrier and recover what it hides
+    tracing.stamp(msg.trace, 'dequeued')
+    key = None
+    if msg.steg_keyed:
+        key = steg_key(msg.name)
+        if key is None:
+            raise SteganographyException('Message from ' + msg.name + ' is keyed, set STEG_KEY to read it')
+    stego = LSBSteg(msg.carrier(CARRIERS), msg.steg_bits, key)
+    if msg.sealed is None:
+        payload = getattr(stego, method)()
+    else:  # encrypted for us with our session key, always hidden as binary
+        data = stego.decode_binary()
+        tracing.stamp(msg.trace, 'decoded')
+        payload = UNSEALED[msg.type](sessions.open_sealed(data, msg.sealed, USERNAME, msg.name, KEYS))
+        tracing.stamp(msg.trace, 'opened')
+        return payload
+    tracing.stamp(msg.trace, 'decoded')
+    return payload
+
+
+def revealed(msg, show):  # Loop side of reveal(), show(msg, payload) unless the decoding failed
+    def done(payload, error):
+        if isinstance(error, (protocol.CarrierMissing, SteganographyException, sessions.SessionError)):
+            print('COULD NOT DECODE MESSAGE:', error)
+        elif error is not None:
+            traceback.print_exception(type(error), error, error.__traceback__)
+        else:
+            try:
+                show(msg, payload)
+            except:
+                traceback.print_exc()
+    return done
 
-        self.maskZEROValues = [254, 253, 251, 247, 239, 223, 191, 127]
-        # Mak used to put zero ex:254->11111110, 253->11111101 .. associated with AND bitwise
-        self.maskZERO = self.maskZEROValues.pop(0)
 
-        self.curwidth = 0  # Current width position
-        self.curheight = 0  # Current height position
-        self.curchan = 0   # Current channel position
+def show_text(msg, text):
+    if msg.trace is not None:
+        tracing.TRACES.record(msg.trace, role='receive', type=msg.type, sender=msg.name, receiver=USERNAME)
+    if msg.type == 'AMSG':
+        print('[PUBLIC]', msg.name, ': ', text)
+    else:
+        print('[PRIVATE]', msg.name,
+              ': ', text)
 
-    def put_binary_value(self, bits):  # Put the bits in the image
-        for c in bits:
-            # Get the pixel value as a list
-            val = list(self.image[self.curheight, self.curwidth])
-            if int(c) == 1:
-                val[self.curchan] = int(
-                    val[self.curchan]) | self.maskONE  # OR with maskONE
-            else:
-                val[self.curchan] = int(
-                    val[self.curchan]) & self.maskZERO  # AND with maskZERO
-
-            self.image[self.curheight, self.curwidth] = tuple(val)
-            self.next_slot()  # Move "cursor" to the next space
-
-    def next_slot(self):  # Move to the next slot were information can be taken or put
-        if self.curchan == self.nbchannels-1:  # Next Space is the following channel
-            self.curchan = 0
-            if self.curwidth == self.width-1:  # Or the first channel of the next pixel of the same line
-                self.curwidth = 0
-                if self.curheight == self.height-1:  # Or the first channel of the first pixel of the next line
-                    self.curheight = 0
-                    if self.maskONE == 128:  # Mask 1000000, so the last mask
-                        raise SteganographyException(
-                            "No available slot remaining (image filled)")
-                    else:  # Or instead of using the first bit start using the second and so on..
-                        self.maskONE = self.maskONEValues.pop(0)
-                        self.maskZERO = self.maskZEROValues.pop(0)
-                else:
-                    self.curheight += 1
-            else:
-                self.curwidth += 1
+
+def save_image(msg, image):
+    os.makedirs(filetransfer.DOWNLOAD_DIR, exist_ok=True)
+    path = filetransfer.unique_path(os.path.join(
+        filetransfer.DOWNLOAD_DIR, filetransfer.safe_name(msg.name, 'someone') + '-image.png'))
+    cv2.imwrite(path, image)
+    print('[IMAGE]', msg.name, ': %dx%d saved to' % (image.shape[1], image.shape[0]), path)
+
+
+def write_chunk(msg, data):  # one chunk of a file, written to disk as soon as it is in order
+    try:
+        path = FILES.receive(msg.name, msg.file, data)
+    except filetransfer.FileTransferError as e:
+        print('[FILE]', msg.name, ':', e)
+    else:
+        if path is not None:
+            print('[FILE]', msg.name, ': received', path)
+
+
+def image_bytes(image):  # Serialized image, for IMG messages that are encrypted and hidden as binary
+    header, pixels = carrier_codecs.pack_array(image)
+    return header + pixels.tobytes()
+
+
+def image_of(data):
+    shape, pixels = carrier_codecs.split_array(data)
+    return carrier_codecs.to_image(pixels, shape)
+
+
+# (LSBSteg method recovering the payload, what to do with it), indexed by message type
+REVEALED = {'AMSG': ('decode_text', show_text), 'DMSG': ('decode_text', show_text),
+            'IMG': ('decode_image', save_image), 'FILE': ('decode_binary', write_chunk)}
+# Payload of a decrypted message, indexed by message type
+UNSEALED = {'AMSG': lambda data: data.decode('latin-1'), 'DMSG': lambda data: data.decode('latin-1'),
+            'IMG': image_of, 'FILE': bytes}
+
+
+def session_for(user, future):  # Loop thread: future gets the (key id, key) to seal for user, None without one
+    session = KEYS.session(user)
+    if session is not None or user not in logged_in_users:
+        future.set_result(session)
+        return
+    PEERS.rekey(user, logged_in_users[user], future)
+
+
+def forget_departed(before, after):  # Drop the session keys of the users who left or came back on another port
+    for user, port in before.items():
+        if after.get(user) != port:
+            KEYS.forget(user)
+
+
+def presence(delta):  # Apply a JOIN/LEAVE, or ask for a full user list when one was missed
+    global logged_in_users, local_addresses, PRESENCE_SEQ, SNAPSHOT_PENDING
+    if delta.seq <= PRESENCE_SEQ:
+        return  # already part of the list we hold
+    if delta.seq != PRESENCE_SEQ + 1:
+        if not SNAPSHOT_PENDING and SERVER_CONN is not None:
+            SNAPSHOT_PENDING = True
+            msg = Msg()
+            msg.type = 'FTCH'
+            SERVER_CONN.send(protocol.pack(msg))
+        return
+    users = dict(logged_in_users)  # readers on other threads keep a consistent list
+    local = dict(local_addresses)
+    local.pop(delta.name, None)
+    if delta.type == 'JOIN':
+        users[delta.name] = delta.port
+        if delta.local:
+            local[delta.name] = delta.local
+    else:
+        users.pop(delta.name, None)
+    forget_departed(logged_in_users, users)
+    logged_in_users = users
+    local_addresses = local
+    PRESENCE_SEQ = delta.seq
+    PEERS.update(logged_in_users)
+
+
+def resolve(response):  # Hand a server answer to the oldest request waiting for one
+    while PENDING:
+        future = PENDING.popleft()
+        if not future.done():
+            future.set_result(response)
+            return
+
+
+def request(msg):  # Send msg to the server from any thread, the Future gets its OK/FAIL answer
+    future = Future()
+
+    def send():
+        if SERVER_CONN is None or SERVER_CONN.closed:
+            future.set_exception(ConnectionError('Not connected to the server'))
+            return
+        PENDING.append(future)
+        SERVER_CONN.send(protocol.pack(msg))
+    LOOP.call_soon_threadsafe(send)
+    return future
+
+
+def relay(user, outgoing, future):  # Send a message to user through the server, future gets the outcome
+    msg = Msg()
+    msg.type = 'RELAY'
+    msg.name = USERNAME
+    msg.to = user
+    try:
+        msg.msg = outgoing.frame(RELAY_CODEC)
+    except Exception as e:
+        finish(future, e)
+        return
+
+    def answered(answer):
+        if answer.exception() is not None:
+            finish(future, answer.exception())
+        elif answer.result().type != 'RACK':
+            finish(future, ConnectionError(answer.result().msg))
         else:
-            self.curchan += 1
-
-    def read_bit(self):  # Read a single bit int the image
-        val = self.image[self.curheight, self.curwidth][self.curchan]
-        val = int(val) & self.maskONE
-        self.next_slot()
-        if val > 0:
-            return "1"
+            finish(future, None)
+    request(msg).add_done_callback(answered)
+
+
+def server_closed(conn):
+    print('CONNECTION TO SERVER LOST', conn.error or '')
+    while PENDING:
+        future = PENDING.popleft()
+        if not future.done():
+            future.set_exception(conn.error or ConnectionError('Connection closed by server'))
+
+
+def finish(future, error):  # Complete a delivery future with the outcome of a send
+    if future.done():
+        return
+    if error is None:
+        future.set_result(None)
+    else:
+        future.set_exception(error)
+
+
+def warn_clear(users, keys):  # Tell who will get a message we could not encrypt for them
+    clear = [user for user in users if user not in keys]
+    if ENCRYPT and clear:
+        print('NOT ENCRYPTED FOR', ', '.join('<' + user + '>' for user in clear) + ': no session key')
+
+
+def finish_value(future, value):
+    if not future.done():
+        future.set_result(value)
+
+
+def host_id():  # Same on every process of this machine, until it reboots
+    try:
+        with open('/proc/sys/kernel/random/boot_id') as file:
+            return socket.gethostname() + '/' + file.read().strip()
+    except OSError:
+        return socket.gethostname()
+
+
+HOST_ID = host_id()
+
+
+def local_path(user):  # Path of the Unix socket user listens on when it runs on this host, None otherwise
+    local = local_addresses.get(user)
+    if not USE_LOCAL or not local or local.get('host') != HOST_ID:
+        return None
+    return local.get('path')
+
+
+def local_listener():  # (socket, path) of our listener for the clients on this host
+    path = os.path.join(tempfile.gettempdir(), 'steg-chat-%d.sock' % os.getpid())
+    try:
+        os.unlink(path)  # left behind by an earlier process with our pid
+    except OSError:
+        pass
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.bind(path)
+    sock.listen(socket.SOMAXCONN)
+    return sock, path
+
+
+class Peer:
+    # Our connection to another client's listener. Messages wait in line until the peer
+    # answered our HELLO and we know which codec and carriers to use for it. A peer on
+    # this host is tried over its Unix socket first, then over TCP when that fails
+    # before the HELLO is answered.
+
+    def __init__(self, pool, user, port):
+        self.pool = pool
+        self.user = user
+        self.port = port
+        self.path = local_path(user)  # None once we are on TCP
+        self.codec = carrier_codecs.RawCodec.name
+        self.carriers = set()
+        self.ready = False
+        self.waiting = deque()  # (outgoing, on_sent) sent before the HELLO answer came back
+        self.handshake = None  # our half of the key exchange under way
+        self.key_waiters = deque()  # futures waiting for it, see session_for
+        self.conn = self.connect()
+        self.timer = LOOP.call_later(pool.timeout, self.on_timeout)
+        self.hello()
+
+    def connect(self):
+        if self.path is not None:
+            try:
+                return eventloop.Connection.connect(LOOP, self.path, self.on_message, self.on_close)
+            except OSError:
+                self.path = None  # stale socket file, the peer may have restarted elsewhere
+        return eventloop.Connection.connect(LOOP, ('', self.port), self.on_message, self.on_close)
+
+    def hello(self):  # Offer our codecs and, when encrypting, start a key exchange
+        hello = Msg()
+        hello.type = 'HELLO'
+        hello.name = USERNAME
+        hello.msg = {'codecs': CODEC_PREFERENCE}
+        if ENCRYPT:
+            self.handshake = sessions.Handshake()
+            hello.msg['dh'] = self.handshake.public
+        self.conn.send(protocol.pack(hello))
+
+    def rekey(self, future):  # future gets a fresh session key, or None when the peer does not encrypt
+        self.key_waiters.append(future)
+        if self.ready and self.handshake is None:
+            self.hello()
+
+    def on_message(self, conn, frame_type, payload):
+        reply = protocol.unpack(payload)
+        if reply.type != 'HELLO':
+            return
+        if self.handshake is not None:
+            if 'dh' in reply.msg:
+                try:
+                    KEYS.put(self.user, self.handshake.finish(reply.msg['dh'], True))
+                except sessions.SessionError as e:
+                    print('NO SESSION KEY WITH <' + self.user + '>:', e)
+            self.handshake = None
+            while self.key_waiters:
+                finish_value(self.key_waiters.popleft(), KEYS.session(self.user))
+        if self.ready:
+            return
+        if reply.msg.get('codec') in carrier_codecs.CODECS:
+            self.codec = reply.msg['codec']
+        self.carriers = set(reply.msg.get('carriers', ()))
+        self.ready = True
+        self.timer.cancel()
+        while self.waiting:
+            self.write(*self.waiting.popleft())
+
+    def fall_back(self, conn):  # Reconnect over TCP when the Unix socket failed before the HELLO answer
+        if self.ready or self.path is None or conn.error is None or isinstance(conn.error, TimeoutError):
+            return False
+        if self.pool.peers.get(self.user) is not self:
+            return False  # dropped on purpose
+        self.path = None
+        try:
+            self.conn = self.connect()
+        except OSError as e:
+            conn.error = e
+            return False
+        self.hello()
+        return True
+
+    def on_timeout(self):
+        self.conn.close(error=TimeoutError('No answer from ' + self.user))
+
+    def on_close(self, conn):
+        if self.fall_back(conn):
+            return
+        self.timer.cancel()
+        while self.key_waiters:
+            finish_value(self.key_waiters.popleft(), None)
+        while self.waiting:
+            self.waiting.popleft()[1](conn.error or ConnectionError('Connection closed by ' + self.user))
+        self.pool.forget(self)
+
+    def submit(self, outgoing, on_sent):
+        if self.ready:
+            self.write(outgoing, on_sent)
         else:
-            return "0"
-
-    def read_byte(self):
-        return self.read_bits(8)
-
-    def read_bits(self, nb):  # Read the given number of bits
-        bits = ""
-        for i in range(nb):
-            bits += self.read_bit()
-        return bits
-
-    def byteValue(self, val):
-        return self.binary_value(val, 8)
-
-    def binary_value(self, val, bitsize):  # Return the binary value of an int as a byte
-        binval = bin(val)[2:]
-        if len(binval) > bitsize:
-            raise SteganographyException(
-                "binary value larger than the expected size")
-        while len(binval) < bitsize:
-            binval = "0"+binval
-        return binval
-
-    def encode_text(self, txt):
-        l = len(txt)
-        # Length coded on 2 bytes so the text size can be up to 65536 bytes long
-        binl = self.binary_value(l, 16)
-        self.put_binary_value(binl)  # Put text length coded on 4 bytes
-        for char in txt:  # And put all the chars
-            c = ord(char)
-            self.put_binary_value(self.byteValue(c))
-        return self.image
-
-    def decode_text(self):
-        ls = self.read_bits(16)  # Read the text size in bytes
-        l = int(ls, 2)
-        i = 0
-        unhideTxt = ""
-        while i < l:  # Read all bytes of the text
-            tmp = self.read_byte()  # So one byte
-            i += 1
-            unhideTxt += chr(int(tmp, 2))  # Every chars concatenated to str
-        return unhideTxt
-
-    def encode_image(self, imtohide):
-        w = imtohide.width
-        h = imtohide.height
-        if self.width*self.height*self.nbchannels < w*h*imtohide.channels:
-            raise SteganographyException(
-                "Carrier image not big enough to hold all the datas to steganography")
-        # Width coded on to byte so width up to 65536
-        binw = self.binary_value(w, 16)
-        binh = self.binary_value(h, 16)
-        self.put_binary_value(binw)  # Put width
-        self.put_binary_value(binh)  # Put height
-        for h in range(imtohide.height):  # Iterate the hole image to put every pixel values
-            for w in range(imtohide.width):
-                for chan in range(imtohide.channels):
-                    val = imtohide[h, w][chan]
-                    self.put_binary_value(self.byteValue(int(val)))
-        return self.image
-
-    def decode_image(self):
-        width = int(self.read_bits(16), 2)  # Read 16bits and convert it in int
-        height = int(self.read_bits(16), 2)
-        # Create an image in which we will put all the pixels read
-        unhideimg = np.zeros((width, height, 3), np.uint8)
-        for h in range(height):
-            for w in range(width):
-                for chan in range(unhideimg.channels):
-                    val = list(unhideimg[h, w])
-                    val[chan] = int(self.read_byte(), 2)  # Read the value
-                    unhideimg[h, w] = tuple(val)
-        return unhideimg
-
-    def encode_binary(self, data):
-        l = len(data)
-        if self.width*self.height*self.nbchannels < l+64:
-            raise SteganographyException(
-                "Carrier image not big enough to hold all the datas to steganography")
-        self.put_binary_value(self.binary_value(l, 64))
-        for byte in data:
-            byte = byte if isinstance(byte, int) else ord(
-                byte)  # Compat py2/py3
-            self.put_binary_value(self.byteValue(byte))
-        return self.image
-
-    def decode_binary(self):
-        l = int(self.read_bits(64), 2)
-        output = b""
-        for i in range(l):
-            output += chr(int(self.read_byte(), 2)).encode("utf-8")
-        return output
+            self.waiting.append((outgoing, on_sent))
+
+    def write(self, outgoing, on_sent):
+        trace = outgoing.msg.trace
+        if trace is not None:  # our side of the trip: serialization, then until the kernel took it
+            trace = {'id': trace['id'], 'stages': [('queued', tracing.clock())]}
+            on_sent = self.traced(trace, on_sent)
+        try:
+            data = outgoing.frame(self.codec, self.carriers)
+        except Exception as e:
+            on_sent(e)
+            return
+        tracing.stamp(trace, 'serialized')
+        self.conn.send(data, on_sent)
+
+    def traced(self, trace, on_sent):
+        def done(error):
+            if error is None:
+                tracing.stamp(trace, 'sent')
+                tracing.TRACES.record(trace, role='send', sender=USERNAME, receiver=self.user)
+            on_sent(error)
+        return done
+
+    def idle(self):
+        return self.ready and not self.waiting and not self.conn.buffered
+
+
+class PeerPool:
+    # Open connections to other clients' listeners, indexed by username, least recently
+    # used first. Only used from the loop thread, except for stats().
+
+    def __init__(self, max_idle=MAX_IDLE_PEERS, timeout=PEER_TIMEOUT):
+        self.max_idle = max_idle
+        self.timeout = timeout
+        self.peers = OrderedDict()  # Peer, indexed by username
+        self.connects = 0
+        self.reuses = 0
+        self.local = 0  # connections opened over a Unix socket
+
+    def peer(self, user, port):  # (open Peer of user, True when it was already open), connecting when needed
+        peer = self.peers.get(user)
+        if peer is not None and (peer.port != port or peer.conn.closed):
+            self.drop(peer)
+            peer = None
+        if peer is None:
+            peer = Peer(self, user, port)
+            self.peers[user] = peer
+            self.connects += 1
+            self.local += peer.path is not None
+            return peer, False
+        self.peers.move_to_end(user)
+        self.reuses += 1
+        return peer, True
+
+    def rekey(self, user, port, future):
+        try:
+            peer, reused = self.peer(user, port)
+        except OSError:
+            finish_value(future, None)
+            return
+        peer.rekey(future)
+
+    def send(self, user, port, outgoing, future, retried=False):
+        # Write a protocol.Outgoing in the form the peer can read, future gets the outcome
+        try:
+            peer, reused = self.peer(user, port)
+        except OSError as e:
+            finish(future, e)
+            return
+
+        def on_sent(error):
+            if error is not None and reused and not retried:
+                # The peer dropped the idle connection in the meantime, try once on a fresh one
+                self.send(user, port, outgoing, future, True)
+            else:
+                finish(future, error)
+        peer.submit(outgoing, on_sent)
+        self.trim()
 
+    def trim(self):  # Close the least recently used idle connections over max_idle
+        idle = [peer for peer in self.peers.values() if peer.idle()]
+        for peer in idle[:max(0, len(idle) - self.max_idle)]:
+            self.drop(peer)
 
-class Server(threading.Thread):
+    def drop(self, peer):
+        self.forget(peer)
+        peer.conn.close()
 
-    sock = None
+    def forget(self, peer):
+        if self.peers.get(peer.user) is peer:
+            del self.peers[peer.user]
 
-    def init(self, sock):
-        self.sock = sock
+    def update(self, users):  # Forget connections to users who left or came back on another port
+        for peer in list(self.peers.values()):
+            if users.get(peer.user) != peer.port:
+                self.drop(peer)
+                KEYS.forget(peer.user)
 
-    def run(self):
-        global logged_in_users, AUTH_STATUS
-        while True:
-            read, write, err = select.select(INPUTS, [], [], 0)
-            for sock in read:
-                if sock == self.sock:
-                    sockfd, addr = self.sock.accept()
-                    INPUTS.append(sockfd)
-                    # print(str(addr))
-                    # print(INPUTS[-1])
-                else:
-                    try:
-                        msg = sock.recv(4096)
-                        if msg == b'':
-                            if sock in OUTPUTS:
-                                OUTPUTS.remove(sock)
-                            INPUTS.remove(sock)
-                            MSGS[sock].clear()
-                            sock.close()
-                        else:
-                            # decode here with own private key
-                            decoded_msg = msg
-                            msg_data = pickle.loads(decoded_msg)
-                            msg_content = msg_data.msg  # decode here with socket's public key then with steganography
-                            type = msg_data.type.strip()
-                            if type == 'AMSG':
-                                print('[PUBLIC]', msg_data.name, ': ', LSBSteg(msg_content).decode_text())
-                            elif type == 'DMSG':
-                                print('[PRIVATE]', msg_data.name,
-                                      ': ', LSBSteg(msg_content).decode_text())
-                            elif type == 'ULST':
-                                logged_in_users = msg_content
-                                print('USERLIST UPDATED')
-                            elif type == 'OK':                                
-                                AUTH_STATUS = 'OK'
-                                print(msg_content)
-                            elif type == 'FAIL':
-                                AUTH_STATUS = 'FAIL'
-                                print(msg_content)
-                            # elif msg_data.type == 'BYE':
-                                # do stuff
-                            else:
-                                print('UNKNOWN MESSAGE TYPE RECEIVED',
-                                      msg_data.type)
-                    except:
-                        continue
-
-
-class Msg:
-    name = ''  # sender name
-    port = 0  # used in authenticatiom
-    pub_key = ''  # used in authenticatiom
-    type = ''  # type of message
-    msg = ''  # content of the message
-    password = ''  # used in authentication
-
-    def __str__(self):
-        out = 'Name : '
-        out += self.name
-        out += ' Port :'
-        out += str(self.port)
-        return out
+    def close_all(self):
+        for peer in list(self.peers.values()):
+            self.drop(peer)
+
+    def stats(self):
+        return {'open': len(self.peers), 'connects': self.connects, 'reuses': self.reuses, 'local': self.local,
+                'open_local': sum(peer.path is not None for peer in self.peers.values())}
+
+
+PEERS = PeerPool()
+FILES = filetransfer.FileReceiver()  # incoming file transfers, only used from the loop thread
+STEGS = stegpool.StegPool(LOOP)  # encodes and decodes, away from the loop thread
 
 
 class Client(threading.Thread):
     sock = None
 
     def init(self):
-        global LISTENER_SOCK, LISTENING_PORT
+        global LISTENER_SOCK, LISTENING_PORT, LOCAL_SOCK, LOCAL_PATH
         LISTENER_SOCK = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         LISTENER_SOCK.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         LISTENER_SOCK.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
         LISTENER_SOCK.setblocking(False)
-        LISTENING_PORT = random.randint(51400, 51500)
-        LISTENER_SOCK.bind(('', LISTENING_PORT))
-        LISTENER_SOCK.listen(2)
-        INPUTS.append(LISTENER_SOCK)
+        LISTENER_SOCK.bind(('', 0))  # any free port, two clients on one host never pick the same
+        LISTENING_PORT = LISTENER_SOCK.getsockname()[1]
+        LISTENER_SOCK.listen(socket.SOMAXCONN)
+        if USE_LOCAL:
+            try:
+                LOCAL_SOCK, LOCAL_PATH = local_listener()
+            except OSError as e:
+                print('NO LOCAL LISTENER, PEERS ON THIS HOST USE TCP:', e)
+        CARRIERS.preload(CARRIER_PATH)
+        CARRIERS.start()
+
+    def sessions(self, users):  # {user: (key id, key)} for the users we can encrypt for, from any thread but the loop's
+        keys = {}
+        futures = {}
+        if not ENCRYPT:
+            return keys
+        online = logged_in_users
+        for user in users:
+            if user not in online:
+                continue  # relayed, it may be kept for days and has to be readable without our session key
+            session = KEYS.session(user)
+            if session is not None:
+                keys[user] = session
+            else:  # no key yet or it expired, the peer has to agree on one
+                futures[user] = Future()
+                LOOP.call_soon_threadsafe(session_for, user, futures[user])
+        concurrent.futures.wait(futures.values(), timeout=PEER_TIMEOUT)
+        for user, future in futures.items():
+            if future.done() and future.result() is not None:
+                keys[user] = future.result()
+        return keys
+
+    def conceal(self, msg, keys, data, hide):
+        # Hide data in a copy of the carrier. Encrypted for every recipient in keys (see sessions)
+        # and hidden as binary, or hidden in the clear by hide(LSBSteg) when keys is empty.
+        msg.name = USERNAME
+        msg.steg_bits = STEG_BITS
+        msg.steg_keyed = bool(STEG_KEY)
+        carrier, carrier_id = CARRIERS.entry(CARRIER_PATH)
+        stego = LSBSteg(carrier.copy(), STEG_BITS, steg_key(USERNAME))
+        tracing.stamp(msg.trace, 'carrier')
+        if keys:
+            ciphertext, msg.sealed = sessions.seal(data, keys)
+            tracing.stamp(msg.trace, 'sealed')
+            image = stego.encode_binary(ciphertext)
+        else:
+            image = hide(stego)
+        tracing.stamp(msg.trace, 'encoded')
+        return protocol.Outgoing(msg, image, carrier, carrier_id)
 
-    def send(self, type, user, text):
-        global USERNAME
+    def encode(self, type, text, keys):  # Build the message once, it is shared by every recipient in keys
         msg = Msg()
-        msg.name = USERNAME
         msg.type = type
-        STEG = LSBSteg(cv2.imread("guc1.png"))
-        encoded_text = STEG.encode_text(text)  # Encode the message using steganography and own private key
-        msg.msg = encoded_text
-        encoded_msg = msg # Encode the message using the recepient's public key
-        recepient_socket = None
-        recepient_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        recepient_socket.connect(('', logged_in_users[user]))
-        recepient_socket.send(pickle.dumps(encoded_msg))
-        recepient_socket.close()
-        """ if user in sockets.keys():
-            recepient_socket = sockets[user]
-        else:
-            recepient_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            recepient_socket.connect(('', logged_in_users[user]))
-            sockets[user] = recepient_socket
-            INPUTS.append(recepient_socket)
-            OUTPUTS.append(recepient_socket)
-        MSGS[user].append(encoded_msg) """
-        
+        msg.trace = tracing.start()
+        try:
+            data = text.encode('latin-1')  # what encode_text hides, one byte per char
+        except UnicodeEncodeError:
+            raise SteganographyException('Only latin-1 text can be hidden')
+        return self.conceal(msg, keys, data, lambda stego: stego.encode_text(text))
+
+    def encode_image(self, image, user):  # Same as encode() for an image hidden pixel for pixel
+        msg = Msg()
+        msg.type = 'IMG'
+        return self.conceal(msg, self.sessions([user]), image_bytes(image), lambda stego: stego.encode_image(image))
+
+    def image_fits(self, image):  # Encrypted images are hidden as binary, behind their shape
+        shape = CARRIERS.get(CARRIER_PATH).shape
+        if max(image.shape[:2]) > 65535 or not steg.fits(shape, image.size, 'image', STEG_BITS):
+            return False
+        return not ENCRYPT or steg.fits(shape, len(carrier_codecs.pack_array(image)[0]) + image.size, 'binary', STEG_BITS)
+
+    def max_text(self):  # Longest message the carrier can hide, encrypted ones are hidden as binary
+        shape = CARRIERS.get(CARRIER_PATH).shape
+        if ENCRYPT:
+            return min(steg.max_payload(shape, 'text', STEG_BITS), steg.max_payload(shape, 'binary', STEG_BITS))
+        return steg.max_payload(shape, 'text', STEG_BITS)
+
+    def deliver(self, user, outgoing):  # Send an already encoded message to one peer, from any thread
+        future = Future()
+        LOOP.call_soon_threadsafe(self.deliver_now, user, outgoing, future)
+        return future
+
+    def deliver_now(self, user, outgoing, future):
+        if user not in logged_in_users:
+            if USE_RELAY:
+                relay(user, outgoing, future)  # the server keeps it until they log in
+            else:
+                finish(future, ConnectionError('USER <' + user + '> IS NOT ONLINE'))
+            return
+        if not USE_RELAY:
+            PEERS.send(user, logged_in_users[user], outgoing, future)
+            return
+        direct = Future()  # the peer may be unreachable even though it is online, fall back to the server
+        direct.add_done_callback(
+            lambda direct: relay(user, outgoing, future) if direct.exception() is not None else finish(future, None))
+        PEERS.send(user, logged_in_users[user], outgoing, direct)
+
+    def encode_chunk(self, user, info, data):
+        msg = Msg()
+        msg.type = 'FILE'
+        msg.file = info
+        return self.conceal(msg, self.sessions([user]), data, lambda stego: stego.encode_binary(data))
+
+    def file_frames(self, file, name, user):  # Generator of one Future of Outgoing per chunk, encoded on STEGS
+        size = steg.max_payload(CARRIERS.get(CARRIER_PATH).shape, 'binary', STEG_BITS)  # encrypted chunks are as long
+        chunks = filetransfer.read_chunks(file, size)
+        for info, data in filetransfer.describe(chunks, os.urandom(8).hex(), name):
+            yield STEGS.run(self.encode_chunk, user, info, data)
+
+    def send_file(self, user, path):
+        # Stream a file of any size to user. FILE_WINDOW chunks are encoded in parallel while
+        # as many are being sent, the next one is only read once the oldest one went out.
+        encoding = deque()
+        sending = deque()
+        count = 0
+        try:
+            with open(path, 'rb') as file:
+                for job in self.file_frames(file, os.path.basename(path), user):
+                    encoding.append(job)
+                    count += 1
+                    if len(encoding) >= FILE_WINDOW:
+                        sending.append(self.deliver(user, encoding.popleft().result()))
+                    if len(sending) >= FILE_WINDOW:
+                        sending.popleft().result(timeout=DELIVERY_TIMEOUT)
+            while encoding:
+                sending.append(self.deliver(user, encoding.popleft().result()))
+            while sending:
+                sending.popleft().result(timeout=DELIVERY_TIMEOUT)
+        except Exception as e:
+            print('COULD NOT SEND', path, 'TO <' + user + '>:', e)
+            return
+        print('SENT', path, 'TO <' + user + '> IN', count, 'CARRIERS')
+
+    def send(self, type, user, text):
+        keys = self.sessions([user])
+        warn_clear([user], keys)
+        return self.deliver(user, self.encode(type, text, keys))
+
+    def broadcast(self, type, text):
+        # Encode once then push the same message to every online peer, the loop writes to all
+        # of them at the same time. The peers we have no session key with get a second copy
+        # hidden in the clear. Returns the delivery result per recipient: None when sent, the
+        # exception otherwise.
+        users = list(logged_in_users.keys())
+        keys = self.sessions(users)
+        clear = [user for user in users if user not in keys]
+        warn_clear(clear, keys)
+        outgoing = {}
+        if keys:
+            sealed = self.encode(type, text, keys)
+            outgoing.update((user, sealed) for user in keys)
+        if clear:
+            plain = self.encode(type, text, {})
+            outgoing.update((user, plain) for user in clear)
+        futures = {user: self.deliver(user, outgoing[user]) for user in users}
+        concurrent.futures.wait(futures.values(), timeout=DELIVERY_TIMEOUT)
+        results = {}
+        for user, future in futures.items():
+            if future.done():
+                results[user] = future.exception()
+            else:
+                results[user] = TimeoutError('Still sending')
+        return results
 
     def run(self):
-        global AUTH_STATUS, USERNAME, SERVER_SOCKET
+        global AUTH_STATUS, USERNAME, SERVER_CONN
         server = Server()
         server.daemon = True
-        server.init(LISTENER_SOCK)
+        server.init(LISTENER_SOCK, LOCAL_SOCK)
         server.start()
-        handle = handle_connections()
-        handle.start()
-        SERVER_SOCKET = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        SERVER_SOCKET.connect(('', ServerPort))
-        INPUTS.append(SERVER_SOCKET)
-        OUTPUTS.append(SERVER_SOCKET)
-        while AUTH_STATUS == 'FAIL': # Login/SignUp loop
+        SERVER_CONN = LOOP.submit(eventloop.Connection.connect, LOOP, ('', ServerPort),
+                                  server.handle, server_closed).result()
+        while AUTH_STATUS != 'OK': # Login/SignUp loop
             msg = Msg()
             msg.port = LISTENING_PORT
+            if LOCAL_PATH is not None:
+                msg.local = {'host': HOST_ID, 'path': LOCAL_PATH}
             initialState = input(
                 "To login enter 'l' and to sign up enter 's'")
             if(initialState == 's'):
@@ -324,9 +778,14 @@ class Client(threading.Thread):
             USERNAME = msg.name
             msg.password = input("Enter your password: ")
             AUTH_STATUS = 'WAITING'
-            MSGS[SERVER_SOCKET].append(msg)
-            while AUTH_STATUS == 'WAITING':
-                pass
+            try:
+                AUTH_STATUS = request(msg).result(timeout=AUTH_TIMEOUT).type
+            except concurrent.futures.TimeoutError:
+                print('NO ANSWER FROM SERVER')
+                AUTH_STATUS = 'FAIL'
+            except ConnectionError as e:
+                print('COULD NOT REACH SERVER:', e)
+                return
         #time.sleep(5)
         while True:
             uinput = input('>>')
@@ -337,52 +796,115 @@ class Client(threading.Thread):
             type = uinput[0].strip()
             if type == 'FTCH':
                 show_user_list()
+            elif type == 'STAT':
+                print('CARRIER CACHE:', CARRIERS.stats())
+                print('PEER CONNECTIONS:', LOOP.submit(PEERS.stats).result())
+                print('CARRIER CODECS:', carrier_codecs.STATS.snapshot())
+                print('STEG WORKERS:', STEGS.stats())
+                print('SLOT ORDERS:', steg.ORDERS.stats())
+                print('SESSION KEYS:', KEYS.stats())
+                show_stats('ENCRYPTION', sessions.METRICS.snapshot())
+                msg = Msg()
+                msg.type = 'STATS'
+                msg.name = USERNAME
+                try:
+                    show_stats('SERVER', request(msg).result(timeout=AUTH_TIMEOUT).msg)
+                except Exception as e:
+                    print('NO SERVER STATS:', e)
+                print('TRACES:', tracing.TRACES.summary())
+            elif type == 'TRACE':  # TRACE: on|off
+                if len(uinput) != 2 or uinput[1].strip() not in ('on', 'off'):
+                    print('INVALID MESSAGE FORMAT')
+                    continue
+                tracing.ENABLED = uinput[1].strip() == 'on'
             elif type == 'DMSG':
                 if len(uinput) != 3:
                     print('INVALID MESSAGE FORMAT')
                     continue
-                if uinput[1].strip() not in logged_in_users.keys():
+                if uinput[1].strip() not in logged_in_users.keys() and not USE_RELAY:
                     print('USER <' + uinput[1].strip() + '> IS NOT ONLINE')
                     continue
-                self.send(type, uinput[1].strip(), uinput[2])
+                user = uinput[1].strip()
+                if len(uinput[2]) > self.max_text():
+                    print('MESSAGE TOO LONG, AT MOST', self.max_text(), 'CHARACTERS')
+                    continue
+                self.send(type, user, uinput[2]).add_done_callback(
+                    lambda future, user=user: future.exception() and print('COULD NOT DELIVER TO <' + user + '>:', future.exception()))
+            elif type == 'IMG':  # IMG: username : path of an image
+                if len(uinput) != 3:
+                    print('INVALID MESSAGE FORMAT')
+                    continue
+                user, path = uinput[1].strip(), uinput[2].strip()
+                image = cv2.imread(path)
+                if image is None:
+                    print('NOT AN IMAGE', path)
+                    continue
+                if not self.image_fits(image):
+                    print('IMAGE TOO LARGE, AT MOST', steg.max_payload(CARRIERS.get(CARRIER_PATH).shape, 'binary', STEG_BITS) // 3 - 5, 'PIXELS')
+                    continue
+                self.deliver(user, self.encode_image(image, user)).add_done_callback(
+                    lambda future, user=user: future.exception() and print('COULD NOT DELIVER TO <' + user + '>:', future.exception()))
+            elif type == 'FILE':  # FILE: username : path
+                if len(uinput) != 3:
+                    print('INVALID MESSAGE FORMAT')
+                    continue
+                user, path = uinput[1].strip(), uinput[2].strip()
+                if not os.path.isfile(path):
+                    print('NO SUCH FILE', path)
+                    continue
+                threading.Thread(target=self.send_file, args=(user, path), daemon=True).start()
             elif type == 'AMSG':
                 if len(uinput) != 2:
                     print('INVALID MESSAGE FORMAT')
                     continue
-                for user in logged_in_users.keys():
-                    self.send(type, user, uinput[1].strip())
+                if len(uinput[1].strip()) > self.max_text():
+                    print('MESSAGE TOO LONG, AT MOST', self.max_text(), 'CHARACTERS')
+                    continue
+                results = self.broadcast(type, uinput[1].strip())
+                for user, error in results.items():
+                    if error is not None:
+                        print('COULD NOT DELIVER TO <' + user + '>:', error)
             else:
                 print('INVALID MESSAGE FORMAT')
 
 
-class handle_connections(threading.Thread):
-    def run(self):
-        while True:
-            read, write, err = select.select([], OUTPUTS, [], 0)
-            for sock in write:
-                while (MSGS[sock] != []):
-                    try:
-                        msg = pickle.dumps(MSGS[sock].pop(0))
-                        sock.sendall(msg)
-                    except:
-                        continue
-
 def show_user_list():
     global logged_in_users
     print('ONLINE USERS:')
     for user in logged_in_users.keys():
         print(user)
 
+def show_stats(title, stats):
+    print(title + ':')
+    for name, series in sorted(stats.items()):
+        for labels, value in sorted(series.items()):
+            if isinstance(value, dict):  # histogram, only the average
+                value = '%d calls, avg %.3f ms' % (value['count'], value['sum'] / max(value['count'], 1) * 1000)
+            print('  ' + name + labels, value)
+
 @atexit.register
 def clean_exit():
-    global AUTH_STATUS, LISTENER_SOCK, SERVER_SOCKET
+    global AUTH_STATUS, LISTENER_SOCK, SERVER_CONN
     msg = Msg()
     msg.type = 'BYE'
     msg.name = USERNAME
-    MSGS[SERVER_SOCKET].append(msg)
+    if SERVER_CONN is not None:
+        sent = Future()
+        LOOP.call_soon_threadsafe(SERVER_CONN.send, protocol.pack(msg), lambda error: finish(sent, error))
+        try:
+            sent.result(timeout=1)
+        except:
+            pass
+        LOOP.call_soon_threadsafe(PEERS.close_all)
     try:
+        for sock in (LISTENER_SOCK, LOCAL_SOCK):
+            if sock is not None:
+                LOOP.submit(LOOP.unlisten, sock).result(timeout=1)  # the loop must not accept on a dead socket
         LISTENER_SOCK.shutdown(socket.SHUT_RDWR)
         LISTENER_SOCK.close()
+        if LOCAL_SOCK is not None:
+            LOCAL_SOCK.close()
+            os.unlink(LOCAL_PATH)
     except:
         print('Failed to exit gracefully')
 
@@ -390,4 +912,6 @@ if __name__ == '__main__':
     print("Starting client")
     cli = Client()
     cli.init()
+    cli.daemon = True  # Ctrl-C in the main thread ends the client even while it waits for input
     cli.start()
+    cli.join()
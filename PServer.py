@@ -5,341 +5,501 @@ import sys
 import traceback
 import threading
 # import thread
-import select
 import json
 import pickle
 import cv2
 import Crypto
-import numpy as np
 import atexit
-from collections import defaultdict
-
-user_list_path = 'user_list.lst'
-INPUTS = []  # readable sockets
-OUTPUTS = []  # writetable sockets
-MSGS = defaultdict(list)  # messages to be sent (queue), indexed by socket
-Users = {}  # user objects, indexed by username
-logged_in_users = {}  # ports, indexed by username
-
-
-class SteganographyException(Exception):
-    pass
-
-
-class LSBSteg():
-    def __init__(self, im):
-        self.image = im
-        self.height, self.width, self.nbchannels = im.shape
-        self.size = self.width * self.height
-
-        self.maskONEValues = [1, 2, 4, 8, 16, 32, 64, 128]
-        # Mask used to put one ex:1->00000001, 2->00000010 .. associated with OR bitwise
-        # Will be used to do bitwise operations
-        self.maskONE = self.maskONEValues.pop(0)
-
-        self.maskZEROValues = [254, 253, 251, 247, 239, 223, 191, 127]
-        # Mak used to put zero ex:254->11111110, 253->11111101 .. associated with AND bitwise
-        self.maskZERO = self.maskZEROValues.pop(0)
-
-        self.curwidth = 0  # Current width position
-        self.curheight = 0  # Current height position
-        self.curchan = 0   # Current channel position
-
-    def put_binary_value(self, bits):  # Put the bits in the image
-        for c in bits:
-            # Get the pixel value as a list
-            val = list(self.image[self.curheight, self.curwidth])
-            if int(c) == 1:
-                val[self.curchan] = int(
-                    val[self.curchan]) | self.maskONE  # OR with maskONE
-            else:
-                val[self.curchan] = int(
-                    val[self.curchan]) & self.maskZERO  # AND with maskZERO
-
-            self.image[self.curheight, self.curwidth] = tuple(val)
-            self.next_slot()  # Move "cursor" to the next space
-
-    def next_slot(self):  # Move to the next slot were information can be taken or put
-        if self.curchan == self.nbchannels-1:  # Next Space is the following channel
-            self.curchan = 0
-            if self.curwidth == self.width-1:  # Or the first channel of the next pixel of the same line
-                self.curwidth = 0
-                if self.curheight == self.height-1:  # Or the first channel of the first pixel of the next line
-                    self.curheight = 0
-                    if self.maskONE == 128:  # Mask 1000000, so the last mask
-                        raise SteganographyException(
-                            "No available slot remaining (image filled)")
-                    else:  # Or instead of using the first bit start using the second and so on..
-                        self.maskONE = self.maskONEValues.pop(0)
-                        self.maskZERO = self.maskZEROValues.pop(0)
-                else:
-                    self.curheight += 1
-            else:
-                self.curwidth += 1
-        else:
-            self.curchan += 1
-
-    def read_bit(self):  # Read a single bit int the image
-        val = self.image[self.curheight, self.curwidth][self.curchan]
-        val = int(val) & self.maskONE
-        self.next_slot()
-        if val > 0:
-            return "1"
-        else:
-            return "0"
-
-    def read_byte(self):
-        return self.read_bits(8)
-
-    def read_bits(self, nb):  # Read the given number of bits
-        bits = ""
-        for i in range(nb):
-            bits += self.read_bit()
-        return bits
-
-    def byteValue(self, val):
-        return self.binary_value(val, 8)
-
-    def binary_value(self, val, bitsize):  # Return the binary value of an int as a byte
-        binval = bin(val)[2:]
-        if len(binval) > bitsize:
-            raise SteganographyException(
-                "binary value larger than the expected size")
-        while len(binval) < bitsize:
-            binval = "0"+binval
-        return binval
-
-    def encode_text(self, txt):
-        l = len(txt)
-        # Length coded on 2 bytes so the text size can be up to 65536 bytes long
-        binl = self.binary_value(l, 16)
-        self.put_binary_value(binl)  # Put text length coded on 4 bytes
-        for char in txt:  # And put all the chars
-            c = ord(char)
-            self.put_binary_value(self.byteValue(c))
-        return self.image
-
-    def decode_text(self):
-        ls = self.read_bits(16)  # Read the text size in bytes
-        l = int(ls, 2)
-        i = 0
-        unhideTxt = ""
-        while i < l:  # Read all bytes of the text
-            tmp = self.read_byte()  # So one byte
-            i += 1
-            unhideTxt += chr(int(tmp, 2))  # Every chars concatenated to str
-        return unhideTxt
-
-    def encode_image(self, imtohide):
-        w = imtohide.width
-        h = imtohide.height
-        if self.width*self.height*self.nbchannels < w*h*imtohide.channels:
-            raise SteganographyException(
-                "Carrier image not big enough to hold all the datas to steganography")
-        # Width coded on to byte so width up to 65536
-        binw = self.binary_value(w, 16)
-        binh = self.binary_value(h, 16)
-        self.put_binary_value(binw)  # Put width
-        self.put_binary_value(binh)  # Put height
-        for h in range(imtohide.height):  # Iterate the hole image to put every pixel values
-            for w in range(imtohide.width):
-                for chan in range(imtohide.channels):
-                    val = imtohide[h, w][chan]
-                    self.put_binary_value(self.byteValue(int(val)))
-        return self.image
-
-    def decode_image(self):
-        width = int(self.read_bits(16), 2)  # Read 16bits and convert it in int
-        height = int(self.read_bits(16), 2)
-        # Create an image in which we will put all the pixels read
-        unhideimg = np.zeros((width, height, 3), np.uint8)
-        for h in range(height):
-            for w in range(width):
-                for chan in range(unhideimg.channels):
-                    val = list(unhideimg[h, w])
-                    val[chan] = int(self.read_byte(), 2)  # Read the value
-                    unhideimg[h, w] = tuple(val)
-        return unhideimg
-
-    def encode_binary(self, data):
-        l = len(data)
-        if self.width*self.height*self.nbchannels < l+64:
-            raise SteganographyException(
-                "Carrier image not big enough to hold all the datas to steganography")
-        self.put_binary_value(self.binary_value(l, 64))
-        for byte in data:
-            byte = byte if isinstance(byte, int) else ord(
-                byte)  # Compat py2/py3
-            self.put_binary_value(self.byteValue(byte))
-        return self.image
-
-    def decode_binary(self):
-        l = int(self.read_bits(64), 2)
-        output = b""
-        for i in range(l):
-            output += chr(int(self.read_byte(), 2)).encode("utf-8")
-        return output
+import os
+import signal
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import eventloop
+import metrics
+import presence
+import protocol
+from protocol import Msg
+from relay import RelayQueue
+from userstore import UserStore
+
+ServerPort = 5535
+Workers = 1  # server processes sharing the port, more than one adds a presence broker in the parent
+MetricsPort = 9535  # Prometheus text endpoint, only on localhost, 0 turns it off
+user_list_path = 'user_list.lst'  # pickled Users of older versions, imported into the store once
+user_store_path = 'users.db'
+STORE = None  # UserStore of every registered account, opened by load_user_list
+relay_path = 'relay'
+RELAY_QUEUE = None  # RelayQueue of the messages waiting for offline users, opened by load_user_list
+AUTH_WORKERS = 2  # threads hashing passwords, PBKDF2 takes tens of ms and must not stall the loop
+AUTH_POOL = ThreadPoolExecutor(AUTH_WORKERS, thread_name_prefix='auth')  # threads start on first use, after the fork
+LOOP = eventloop.EventLoop()
+CONNECTIONS = set()  # open client connections
+# Output limits of every client connection, see eventloop.Connection. A client that lets
+# more than max_buffer bytes pile up is disconnected so it cannot hold up the others.
+WRITE_LIMITS = {'high_water': eventloop.HIGH_WATER, 'low_water': eventloop.LOW_WATER,
+                'max_buffer': eventloop.MAX_BUFFER, 'overflow': eventloop.DISCONNECT}
+Users = {}  # user objects of the online users connected to this process, indexed by username
+logged_in_users = {}  # ports, indexed by username, of every online user whatever process holds them
+local_addresses = {}  # same host addresses ({'host', 'path'}) of the online users that listen on one, indexed by username
+SESSIONS = {}  # logged in username, indexed by connection
+CLAIMING = {}  # username being checked or claimed from the broker, indexed by connection
+# Answers of a connection in request order, indexed by connection while one of them is still
+# pending. Each is [frames], frames is None until the answer is known. Clients match answers
+# to their requests by order, so a fast one must not overtake one waiting for the broker.
+REPLIES = {}
+PRESENCE_SEQ = 0  # bumped by every JOIN/LEAVE so clients can tell when they missed one
+BROKER = None  # eventloop.Connection to the presence broker when running as one of several workers
+BROKER_PENDING = deque()  # callbacks waiting for the broker's answers, oldest first
+METRICS = metrics.Registry('pserver')
+MESSAGE_TYPES = ('REG', 'LOGIN', 'FTCH', 'RELAY', 'STATS', 'BYE')  # anything else is counted as unknown
+CLOSED_TRAFFIC = {'sent': 0, 'received': 0}  # bytes of the connections already gone
 
 
 class Server(threading.Thread):
 
-    def init(self):
-        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
-        self.sock.setblocking(False)
-        self.sock.bind(('', 5535))
-        self.sock.listen(2)
-        INPUTS.append(self.sock)
-        print("Server started on port 5535")
-    
-    def notify_userlist_update(self):
+    def init(self, port=ServerPort, metrics_port=MetricsPort, sock=None):
+        self.sock = sock or listener(port)
+        LOOP.listen(self.sock, self.accept)
+        print("Server started on port", port)
+        self.init_metrics(metrics_port)
+
+    def init_broker(self, sock):  # Join the other workers through the broker on the other end of sock
+        global BROKER
+        BROKER = eventloop.Connection(LOOP, sock, self.from_broker, self.broker_lost, **presence.LINK_LIMITS)
+
+    def ask_broker(self, msg, on_answer):
+        BROKER_PENDING.append(on_answer)
+        BROKER.send(protocol.pack(msg))
+
+    def from_broker(self, link, frame_type, payload):
+        msg = protocol.unpack(payload)
+        if msg.type == 'JOIN' or msg.type == 'LEAVE':
+            self.apply_presence(msg, protocol.frame(payload))
+        elif msg.type == 'DLVR':
+            self.deliver(msg.to, msg.msg)
+        elif BROKER_PENDING:
+            BROKER_PENDING.popleft()(msg)
+
+    def broker_lost(self, link):
+        print('Presence broker gone, stopping', link.error or '')
+        LOOP.stop()
+
+    def init_metrics(self, port):
+        LOOP.on_iteration = lambda seconds: METRICS.observe('loop_iteration_seconds', seconds)
+        METRICS.collect('connections', lambda: len(CONNECTIONS))
+        METRICS.collect('logged_in_users', lambda: len(logged_in_users))
+        METRICS.collect('sent_bytes_total', lambda: CLOSED_TRAFFIC['sent'] + sum(c.sent for c in CONNECTIONS), 'counter')
+        METRICS.collect('received_bytes_total',
+                        lambda: CLOSED_TRAFFIC['received'] + sum(c.received for c in CONNECTIONS), 'counter')
+        METRICS.collect('paused_connections', lambda: sum(1 for c in CONNECTIONS if c.paused))
+        # Output waiting per logged in user, where a slow reader shows up first
+        METRICS.collect('output_queue_bytes', lambda: [({'user': n}, u.sock.buffered) for n, u in list(Users.items())])
+        METRICS.collect('output_queue_messages', lambda: [({'user': n}, len(u.sock.outq)) for n, u in list(Users.items())])
+        METRICS.collect('dropped_messages_total', lambda: sum(c.dropped for c in CONNECTIONS), 'counter')
+        METRICS.collect('relay_queued_total', lambda: RELAY_QUEUE.queued, 'counter')
+        METRICS.collect('relay_delivered_total', lambda: RELAY_QUEUE.delivered, 'counter')
+        METRICS.collect('user_store_open_seconds', lambda: STORE.load_seconds)
+        if not port:
+            return
+        try:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            sock.bind(('127.0.0.1', port))
+            sock.listen(16)
+        except OSError as e:
+            print('Metrics endpoint disabled:', e)
+            return
+        metrics.serve_http(LOOP, sock, METRICS.render)
+        print("Metrics on http://127.0.0.1:%d/metrics" % port)
+
+    def userlist(self):  # Full presence snapshot, as of the current sequence number
         msg = Msg()
         msg.type = 'ULST'
         msg.msg = logged_in_users
-        for user in Users:
-            print('sending user list to', user)
-            MSGS[Users[user].sock].append(msg)            
+        msg.local = local_addresses
+        msg.seq = PRESENCE_SEQ
+        return msg
+
+    def notify_presence(self, type, name, port, local=None):
+        # Send a JOIN/LEAVE delta to every other online user instead of the whole list
+        global PRESENCE_SEQ
+        PRESENCE_SEQ += 1
+        msg = Msg()
+        msg.type = type
+        msg.name = name
+        msg.port = port
+        msg.local = local
+        msg.seq = PRESENCE_SEQ
+        self.fan_out(name, protocol.pack(msg))  # serialized once for everybody
+
+    def fan_out(self, name, data):
+        for user in list(Users):
+            if user != name and Users[user].sock is not None:
+                Users[user].sock.send(data)  # never blocks, a slow client only fills its own queue
+
+    def apply_presence(self, msg, data):  # A JOIN/LEAVE numbered by the broker, data is its frame
+        global PRESENCE_SEQ
+        if msg.type == 'JOIN':
+            logged_in_users[msg.name] = msg.port
+            if msg.local:
+                local_addresses[msg.name] = msg.local
+        else:
+            logged_in_users.pop(msg.name, None)
+            local_addresses.pop(msg.name, None)
+        PRESENCE_SEQ = msg.seq
+        self.fan_out(msg.name, data)
+
+    def reply(self, conn, data):  # Answer the request just handled, after the earlier ones still pending
+        queue = REPLIES.get(conn)
+        if queue is None:
+            conn.send(data)
+        else:
+            queue.append([(data,)])
+
+    def reply_later(self, conn):  # Place in line for an answer that is not known yet, see answer()
+        slot = [None]
+        REPLIES.setdefault(conn, deque()).append(slot)
+        return slot
+
+    def answer(self, conn, slot, *frames):  # Fill slot, then send every answer in line up to the next pending one
+        slot[0] = frames
+        queue = REPLIES.get(conn)
+        while queue and queue[0][0] is not None:
+            for data in queue.popleft()[0]:
+                conn.send(data)
+        if queue is not None and not queue:
+            del REPLIES[conn]
+
+    def authenticate(self, conn, msg, check, text, failure):
+        # Run check(name, password) on AUTH_POOL, then log the user in or answer FAIL with failure
+        start = time.perf_counter()
+        CLAIMING[conn] = msg.name
+        slot = self.reply_later(conn)
+        future = AUTH_POOL.submit(check, msg.name, msg.password)
+        future.add_done_callback(lambda future: LOOP.call_soon_threadsafe(
+            self.authenticated, conn, msg, future, text, failure, slot, start))
+
+    def authenticated(self, conn, msg, future, text, failure, slot, start):
+        METRICS.observe('auth_seconds', time.perf_counter() - start, type=msg.type)
+        if conn.closed:
+            return
+        if future.exception() is not None:
+            print('Password check failed', future.exception())
+        if future.exception() is None and future.result() and msg.name not in logged_in_users:
+            print('User', msg.name, 'signed up' if msg.type == 'REG' else 'logged in successfully')
+            self.claim(conn, msg.name, msg.port, msg.local, text, slot)
+            return
+        print(failure, msg.name)
+        CLAIMING.pop(conn, None)
+        response = Msg()
+        response.type = 'FAIL'
+        response.msg = failure
+        self.answer(conn, slot, protocol.pack(response))
+
+    def claim(self, conn, name, port, local, text, slot):  # Log name in and answer OK, the broker decides when there is one
+        if BROKER is None:
+            CLAIMING.pop(conn, None)
+            self.log_in(conn, name, port, local)
+            self.welcome(conn, text, slot)
+            return
+        CLAIMING[conn] = name
+        msg = Msg()
+        msg.type = 'CLAIM'
+        msg.name = name
+        msg.port = port
+        msg.local = local
+
+        def answered(answer):
+            CLAIMING.pop(conn, None)
+            if answer.type != 'OK':
+                self.answer(conn, slot, protocol.pack(answer))
+            elif conn.closed:  # left while the broker was asked
+                self.release(name)
+            else:
+                self.log_in(conn, name, port, local)
+                self.welcome(conn, text, slot)
+        self.ask_broker(msg, answered)
 
+    def release(self, name):
+        msg = Msg()
+        msg.type = 'RELEASE'
+        msg.name = name
+        BROKER.send(protocol.pack(msg))
+
+    def welcome(self, conn, text, slot):
+        response = Msg()
+        response.type = 'OK'
+        response.msg = text
+        self.answer(conn, slot, protocol.pack(response),
+                    protocol.pack(self.userlist()))  # the newcomer starts from a snapshot
+        self.flush_relayed(conn, SESSIONS[conn])
+
+    def log_in(self, conn, name, port, local=None):
+        user = User()
+        user.name = name
+        user.port = port
+        user.sock = conn
+        Users[name] = user
+        SESSIONS[conn] = name
+        if BROKER is None:  # otherwise the JOIN came from the broker already
+            logged_in_users[name] = port
+            if local:
+                local_addresses[name] = local
+            self.notify_presence('JOIN', name, port, local)
+
+    def log_out(self, name):
+        if name in Users:
+            print('User', name, 'logged out')
+            del Users[name]
+            if BROKER is not None:
+                self.release(name)  # the LEAVE comes back from the broker
+                return
+            del logged_in_users[name]
+            local_addresses.pop(name, None)
+            self.notify_presence('LEAVE', name, None)
+
+    def in_session(self, conn):  # Logged in, or about to be
+        return conn in SESSIONS or conn in CLAIMING
+
+    def relay(self, conn, msg):  # Forward a framed message to msg.to, or keep it on disk while they are offline
+        response = Msg()
+        response.type = 'RNAK'
+        response.name = msg.to
+        if conn not in SESSIONS:
+            response.msg = 'Not logged in'
+        elif not isinstance(msg.msg, bytes) or not protocol.is_frame(msg.msg):
+            response.msg = 'Malformed message'
+        elif len(msg.msg) > WRITE_LIMITS['max_buffer']:  # would close the recipient's connection at every login
+            response.msg = 'Message too large for ' + msg.to
+        # A connection that refuses the frame is going away, the branches below queue it for the next login
+        elif msg.to in Users and not RELAY_QUEUE.is_draining(msg.to) and Users[msg.to].sock.send(msg.msg):
+            response.type = 'RACK'
+            response.msg = 'Relayed to ' + msg.to
+        elif BROKER is not None and msg.to not in Users:  # online on another worker, or offline
+            forward = Msg()
+            forward.type = 'FWD'
+            forward.to = msg.to
+            forward.msg = msg.msg
+            slot = self.reply_later(conn)
+            self.ask_broker(forward, lambda answer: self.answer(conn, slot, protocol.pack(answer)))
+            return None  # answered once the broker did
+        elif not STORE.exists(msg.to):
+            response.msg = 'Unknown user ' + msg.to
+        elif RELAY_QUEUE.append(msg.to, msg.msg):
+            response.type = 'RACK'
+            response.msg = 'Queued for ' + msg.to
+        else:
+            response.msg = 'Too many messages waiting for ' + msg.to
+        return response
+
+    def deliver(self, name, data):  # A frame the broker relayed to one of our users
+        if name in Users and not RELAY_QUEUE.is_draining(name) and Users[name].sock.send(data):
+            return
+        if not RELAY_QUEUE.append(name, data):  # left in the meantime, still getting the backlog or too slow
+            print('Relayed message to', name, 'dropped, too many waiting')
+
+    def flush_relayed(self, conn, name):  # Deliver what was queued while name was offline
+        if RELAY_QUEUE.pending(name):
+            RELAY_QUEUE.drain(name, conn, lambda count: print('Delivered', count, 'queued messages to', name))
+
+    def accept(self, sockfd, addr):
+        sockfd.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        conn = eventloop.Connection(LOOP, sockfd, self.handle, self.closed, **WRITE_LIMITS)
+        CONNECTIONS.add(conn)
+        print(str(addr))
+
+    def closed(self, conn):
+        CONNECTIONS.discard(conn)
+        CLOSED_TRAFFIC['sent'] += conn.sent
+        CLOSED_TRAFFIC['received'] += conn.received
+        CLAIMING.pop(conn, None)
+        REPLIES.pop(conn, None)
+        name = SESSIONS.pop(conn, None)
+        if name is not None:  # went away without a BYE
+            self.log_out(name)
+        if isinstance(conn.error, BufferError):
+            print('Dropped slow client', conn.error)
+
+    def handle(self, conn, frame_type, payload):
+        start = time.perf_counter()
+        label = 'unknown'  # message type the counters and handler latencies are recorded under
+        try:
+            msg_data = protocol.unpack(payload)
+            print(msg_data.type, "MESSAGE TYPE")
+            if msg_data.type in MESSAGE_TYPES:
+                label = msg_data.type
+            if(msg_data.type == 'REG'):
+                if not self.in_session(conn):  # STORE.add commits before the OK
+                    self.authenticate(conn, msg_data, STORE.add, 'Signed up successfully', 'Username Already Taken')
+                    return
+                else:
+                    print('User Already Exists')
+                    response = Msg()
+                    response.type = 'FAIL'
+                    response.msg = 'Username Already Taken'
+            elif (msg_data.type == 'LOGIN'):
+                if (not self.in_session(conn) and msg_data.name not in logged_in_users.keys()):
+                    self.authenticate(conn, msg_data, STORE.check, 'Signed in successfully', 'Invalid username/password')
+                    return
+                else:
+                    print('Invalid username/password',
+                          msg_data.name)
+                    response = Msg()
+                    response.type = 'FAIL'
+                    response.msg = 'Invalid username/password'
+            elif (msg_data.type == 'FTCH'):
+                print('Userlist requested', msg_data.name)
+                response = self.userlist()
+            elif (msg_data.type == 'RELAY'):
+                response = self.relay(conn, msg_data)
+                if response is None:
+                    return
+            elif (msg_data.type == 'STATS'):
+                response = Msg()
+                response.type = 'STATS'
+                response.msg = METRICS.snapshot()
+            elif (msg_data.type == 'BYE'):
+                name = SESSIONS.pop(conn, None)  # only the session's own user can be logged out
+                if name is not None:
+                    self.log_out(name)
+                conn.close()  # discard any messages to be sent to this user
+                return
+            else:
+                print('Unknown message type', msg_data.type)
+                return
+            self.reply(conn, protocol.pack(response))
+        except:
+            METRICS.inc('handler_errors_total', type=label)
+            traceback.print_exc()
+        finally:
+            METRICS.inc('messages_total', type=label)
+            METRICS.observe('handler_seconds', time.perf_counter() - start, type=label)
 
     def run(self):
-        while True:
-            read, write, err = select.select(INPUTS, [], [], 0)
-            for sock in read:
-                if sock == self.sock:
-                    sockfd, addr = self.sock.accept()
-                    INPUTS.append(sockfd)
-                    print(str(addr))
-                    print(INPUTS[-1])
-                else:
-                    try:
-                        msg = sock.recv(4096)
-                        if msg == b'':
-                            if sock in OUTPUTS:
-                                OUTPUTS.remove(sock)
-                            INPUTS.remove(sock)
-                            MSGS[sock].clear()
-                            sock.close()
-                        else:
-                            new_user_added = False
-                            msg_data = pickle.loads(msg)
-                            print(msg_data.type, "MESSAGE TYPE")
-                            if(msg_data.type == 'REG'):
-                                if(msg_data.name not in Users.keys()):
-                                    print('USER REGISTERATION')
-                                    user = User()
-                                    user.name = msg_data.name
-                                    user.password = msg_data.password
-                                    user.sock = sock
-                                    user.port = msg_data.port
-                                    print(user.name, "NEW USER")
-                                    Users[user.name] = user
-                                    logged_in_users[user.name] = user.port
-                                    response = Msg()
-                                    response.type = 'OK'
-                                    response.msg = 'Signed up successfully'
-                                    new_user_added = True
-                                else:
-                                    print('User Already Exists')
-                                    response = Msg()
-                                    response.type = 'FAIL'
-                                    response.msg = 'Username Already Taken'
-                            elif (msg_data.type == 'LOGIN'):
-                                if (msg_data.name in Users.keys() and Users[msg_data.name].password == msg_data.password and msg_data.name not in logged_in_users.keys()):
-                                    print('User logged in successfully',
-                                          msg_data.name)
-                                    Users[msg_data.name].port = msg_data.port
-                                    Users[msg_data.name].sock = sock
-                                    logged_in_users[msg_data.name] = msg_data.port
-                                    response = Msg()
-                                    response.type = 'OK'
-                                    response.msg = 'Signed in successfully'
-                                    new_user_added = True
-                                else:
-                                    print('Invalid username/password',
-                                          msg_data.name)
-                                    response = Msg()
-                                    response.type = 'FAIL'
-                                    response.msg = 'Invalid username/password'
-                            elif (msg_data.type == 'FTCH'):
-                                print('Userlist requested', msg.name)
-                                response = Msg()
-                                response.msg = logged_in_users
-                                response.type = 'ULST'
-                            elif (msg_data.type == 'BYE'):
-                                if logged_in_users[msg_data.name]:
-                                    print('User', msg_data.name, 'logged out')
-                                    Users[msg_data.name].socket = None
-                                    del logged_in_users[msg_data.name]
-                                try:
-                                    INPUTS.remove(sock)
-                                    OUTPUTS.remove(sock)
-                                    sock.shutdown(socket.SHUT_RDWR)
-                                    sock.close()
-                                    del MSGS[sock]
-                                    break  # discard any messages to be sent to this user
-                                except:
-                                    continue
-                            else:
-                                print('Unknown message type', msg_data.type)
-                                continue
-                            MSGS[sock].append(response)
-                            if sock not in OUTPUTS:
-                                OUTPUTS.append(sock)
-                            if new_user_added:
-                                self.notify_userlist_update()
-                    except:
-                        traceback.print_exc()
-                        continue
-
-
-class Msg:
-    name = ''  # sender name
-    port = 0  # used in authenticatiom
-    pub_key = ''  # used in authenticatiom
-    type = ''  # type of message
-    msg = ''  # content of the message
-    password = ''  # used in authentication
+        LOOP.run_forever()
+
+
+def listener(port, reuse_port=False):
+    # Listening socket for the clients. With reuse_port every worker binds its own and
+    # the kernel spreads the new connections over them.
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if reuse_port:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    sock.setblocking(False)
+    sock.bind(('', port))
+    sock.listen(socket.SOMAXCONN)
+    return sock
+
+
+def run_workers(count, port, metrics_port):
+    # Fork count server processes sharing port and keep the presence broker in this one.
+    # Worker i serves its metrics on metrics_port + i.
+    global STORE
+    shared = None
+    if not hasattr(socket, 'SO_REUSEPORT'):  # pre-fork accept: one socket, every worker waits on it
+        shared = listener(port)
+    STORE.close()  # an SQLite connection must not cross a fork, everybody opens their own
+    links = []
+    children = []
+    for i in range(count):
+        ours, theirs = socket.socketpair()
+        pid = os.fork()
+        if pid == 0:
+            ours.close()
+            for link in links:
+                link.close()
+            code = 1
+            try:
+                run_worker(i, theirs, shared or listener(port, True), port, metrics_port + i if metrics_port else 0)
+                code = 0
+            except KeyboardInterrupt:
+                code = 0
+            except:
+                traceback.print_exc()
+            finally:
+                os._exit(code)
+        theirs.close()
+        links.append(ours)
+        children.append(pid)
+    if shared is not None:
+        shared.close()
+    STORE = UserStore(user_store_path)
+    broker = presence.Broker(LOOP, STORE, RELAY_QUEUE, WRITE_LIMITS['max_buffer'])
+    for link in links:
+        broker.add_worker(link)
+    print("Server started on port", port, "with", count, "workers")
+    stop_on_signal()
+    try:
+        LOOP.run_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for pid in children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass
+        for pid in children:
+            os.waitpid(pid, 0)
+
+
+def stop_on_signal():  # SIGTERM ends the loop, the wakeup byte gets it out of select()
+    signal.set_wakeup_fd(LOOP.waker.fileno())
+    signal.signal(signal.SIGTERM, lambda signum, frame: LOOP.stop())
+
+
+def run_worker(index, link, sock, port, metrics_port):  # In a forked child, until the broker goes away
+    global LOOP, STORE
+    LOOP = eventloop.EventLoop()  # the parent's selector is not ours to use
+    STORE = UserStore(user_store_path)
+    stop_on_signal()
+    srv = Server()
+    print('Worker', index, 'pid', os.getpid())
+    srv.init(port, metrics_port, sock)
+    srv.init_broker(link)
+    try:
+        LOOP.run_forever()
+    finally:
+        STORE.close()
 
 
 class User:
     name = ''
     port = None
     pub_key = ''
-    password = ''
     sock = None
 
 
-class handle_connections(threading.Thread):
-    def run(self):
-        while True:
-            read, write, err = select.select([], OUTPUTS, [], 0)
-            for sock in write:
-                while (MSGS[sock] != []):
-                    try:
-                        msg = pickle.dumps(MSGS[sock].pop(0))
-                        sock.sendall(msg)
-                    except:
-                        continue
-
-
 def load_user_list():
-    global Users
-    with open(user_list_path, 'rb') as file:
-        Users = pickle.load(file)
+    global STORE, RELAY_QUEUE
+    STORE = UserStore(user_store_path)
+    RELAY_QUEUE = RelayQueue(relay_path)
+    if STORE.empty() and os.path.exists(user_list_path):  # first start since the pickled list
+        with open(user_list_path, 'rb') as file:
+            old = pickle.load(file)
+        print('Imported', STORE.import_users((u.name, u.password) for u in old.values()), 'users from', user_list_path)
+    print('User store opened in %.3f ms' % (STORE.load_seconds * 1000))
 
 
 @atexit.register
-def save_user_list():
-    global Users
-    with open(user_list_path, 'wb') as file:
-        pickle.dump(Users, file)
+def save_user_list():  # Every registration is already on disk, just close the database
+    if STORE is not None:
+        STORE.close()
 
 
 if __name__ == '__main__':
+    # python PServer.py [port [metrics port [workers]]]
+    port = int(sys.argv[1]) if len(sys.argv) > 1 else ServerPort
+    metrics_port = int(sys.argv[2]) if len(sys.argv) > 2 else MetricsPort
+    workers = int(sys.argv[3]) if len(sys.argv) > 3 else Workers
     load_user_list()
-    srv = Server()
-    srv.init()
-    srv.start()
-    handle = handle_connections()
-    handle.start()
+    if workers > 1:
+        run_workers(workers, port, metrics_port)
+    else:
+        srv = Server()
+        srv.init(port, metrics_port)
+        srv.start()
+        srv.join()  # AUTH_POOL takes no more work once the main thread is done
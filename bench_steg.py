@@ -0,0 +1,175 @@
+#! /usr/bin/env python
+
+# Micro-benchmarks of LSBSteg. Every case hides a payload in a carrier and reads it back,
+# timing each call separately, then reports latency percentiles, throughput and the
+# peak memory of one call. Results are written as JSON and can be compared against
+# a stored baseline, the exit status is 1 when a case got slower than allowed.
+#
+#   python bench_steg.py --out bench.json
+#   python bench_steg.py --baseline bench.json --threshold 0.2
+
+import argparse
+import json
+import platform
+import sys
+import time
+import tracemalloc
+import cv2
+import numpy as np
+import LSBSteg as steg
+from LSBSteg import LSBSteg
+
+CARRIER_PATH = 'guc1.png'
+RESOLUTIONS = [(64, 64), (256, 256), (720, 1280)]  # synthetic carriers, (height, width)
+PAYLOADS = [10, 100, 1000, 10000, 100000]  # bytes, cases larger than the carrier are skipped
+IMAGE_SIDES = [4, 16, 64]  # hidden images for encode_image, side in pixels
+NOISE_FLOOR = 5e-6  # seconds, a slower median by less than this is timer noise, not a regression
+
+
+def carriers():  # (name, image), the real carrier first
+    out = []
+    image = cv2.imread(CARRIER_PATH)
+    if image is not None:
+        out.append(('guc1', image))
+    rng = np.random.RandomState(0)
+    for height, width in RESOLUTIONS:
+        out.append(('%dx%d' % (width, height), rng.randint(0, 256, (height, width, 3)).astype(np.uint8)))
+    return out
+
+
+def plane_bytes(image):  # Bytes that fit in the first bit-plane
+    return image.size // 8
+
+
+def text_payload(n):
+    return ''.join(chr(ord('a') + i % 26) for i in range(n))
+
+
+def measure(run, prepare, repeat):
+    # Call run(prepare()) repeat times, only run is timed. Returns the latencies in seconds
+    # and the peak memory allocated by one extra traced call.
+    run(prepare())  # warm up caches and lazy imports
+    latencies = []
+    for i in range(repeat):
+        arg = prepare()
+        start = time.perf_counter()
+        run(arg)
+        latencies.append(time.perf_counter() - start)
+    arg = prepare()
+    tracemalloc.start()
+    run(arg)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return latencies, peak
+
+
+def summary(latencies, peak, bits):
+    lat = np.array(latencies)
+    return {'calls': len(latencies), 'payload_bits': bits,
+            'mean_s': float(lat.mean()), 'p50_s': float(np.percentile(lat, 50)),
+            'p90_s': float(np.percentile(lat, 90)), 'p99_s': float(np.percentile(lat, 99)),
+            'bits_per_s': bits / float(lat.mean()) if lat.mean() > 0 else 0.0,
+            'peak_bytes': peak}
+
+
+def bench_pair(results, name, carrier, encode, decode, bits, repeat, k=0, key=None):
+    # Benchmark one encode/decode method pair on a private copy of carrier per call,
+    # k bits per channel, slots in the order of key when there is one
+    try:
+        stego = encode(LSBSteg(carrier.copy(), k, key))
+        results[name + '/encode'] = summary(*measure(lambda s: encode(s),
+                                                     lambda: LSBSteg(carrier.copy(), k, key), repeat), bits)
+        results[name + '/decode'] = summary(*measure(lambda s: decode(s),
+                                                     lambda: LSBSteg(stego.copy(), k, key), repeat), bits)
+    except Exception as e:  # a broken method is reported, it does not stop the suite
+        results[name] = {'error': '%s: %s' % (type(e).__name__, e)}
+
+
+def cases(image, k):  # Payload sizes for a carrier, plus the ones right around the first bit-plane
+    most = steg.max_payload(image.shape, 'binary', k)
+    sizes = [n for n in PAYLOADS if n < most]
+    if k:
+        return sorted(set(sizes + [most]))
+    edge = plane_bytes(image)
+    return sorted(set(sizes + [edge - 16, edge + 16, most]))
+
+
+def run_suite(repeat, ks=(0,), key=None):
+    results = {}
+    for cname, image in carriers():
+        for k in ks:
+            mode = '/k%d' % k if k else ''  # names of the default layout stay comparable with old baselines
+            if key:
+                mode += '/keyed'
+            for n in cases(image, k):
+                if n <= 0:
+                    continue
+                tag = ' spill' if not k and n * 8 > image.size else ''
+                if steg.fits(image.shape, n, 'text', k):
+                    text = text_payload(n)
+                    bench_pair(results, 'text/%s%s/%dB%s' % (cname, mode, n, tag), image,
+                               lambda s, text=text: s.encode_text(text),
+                               lambda s: s.decode_text(), n * 8, repeat, k, key)
+                data = np.random.RandomState(n).bytes(n)
+                bench_pair(results, 'binary/%s%s/%dB%s' % (cname, mode, n, tag), image,
+                           lambda s, data=data: s.encode_binary(data),
+                           lambda s: s.decode_binary(), n * 8, repeat, k, key)
+        for side in IMAGE_SIDES:
+            hidden = np.random.RandomState(side).randint(0, 256, (side, side, 3)).astype(np.uint8)
+            if not steg.fits(image.shape, hidden.nbytes, 'image'):
+                continue
+            bench_pair(results, 'image/%s%s/%dx%d' % (cname, '/keyed' if key else '', side, side), image,
+                       lambda s, hidden=hidden: s.encode_image(hidden),
+                       lambda s: s.decode_image(), hidden.nbytes * 8, repeat, 0, key)
+    return results
+
+
+def compare(results, baseline, threshold):  # Cases whose median latency grew by more than threshold
+    regressions = []
+    for name, now in sorted(results.items()):
+        before = baseline.get(name)
+        if before is None or 'p50_s' not in now or 'p50_s' not in before:
+            continue
+        change = now['p50_s'] / before['p50_s'] - 1 if before['p50_s'] > 0 else 0.0
+        flag = 'REGRESSION' if change > threshold and now['p50_s'] - before['p50_s'] > NOISE_FLOOR else ''
+        print('%-45s %10.1f us %10.1f us %+7.1f%% %s' % (name, before['p50_s'] * 1e6, now['p50_s'] * 1e6,
+                                                          change * 100, flag))
+        if flag:
+            regressions.append(name)
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='LSBSteg micro-benchmarks')
+    parser.add_argument('--repeat', type=int, default=50, help='timed calls per case')
+    parser.add_argument('--out', help='write the results to this JSON file')
+    parser.add_argument('--baseline', help='JSON results of an earlier run to compare against')
+    parser.add_argument('--bits', default='0', help='comma separated bits per channel to run, 0 is the default layout')
+    parser.add_argument('--key', help='scatter the payload in the slot order of this key')
+    parser.add_argument('--threshold', type=float, default=0.10, help='allowed median slowdown, 0.1 is 10%%')
+    args = parser.parse_args()
+
+    key = args.key.encode('utf-8') if args.key else None
+    results = run_suite(args.repeat, [int(k) for k in args.bits.split(',')], key)
+    for name, r in sorted(results.items()):
+        if 'error' in r:
+            print('%-45s %s' % (name, r['error']))
+        else:
+            print('%-45s p50 %10.1f us  p99 %10.1f us  %12.0f bit/s  peak %8d B'
+                  % (name, r['p50_s'] * 1e6, r['p99_s'] * 1e6, r['bits_per_s'], r['peak_bytes']))
+    if args.out:
+        with open(args.out, 'w') as file:
+            json.dump({'python': platform.python_version(), 'numpy': np.__version__,
+                       'machine': platform.machine(), 'time': time.time(), 'repeat': args.repeat,
+                       'results': results}, file, indent=1, sort_keys=True)
+    if args.baseline:
+        with open(args.baseline) as file:
+            baseline = json.load(file)['results']
+        regressions = compare(results, baseline, args.threshold)
+        if regressions:
+            print(len(regressions), 'case(s) slower than the baseline allows')
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,160 @@
+#! /usr/bin/env python
+
+import struct
+import threading
+import time
+import zlib
+from collections import OrderedDict
+import cv2
+import numpy as np
+
+try:
+    import lz4.frame
+except ImportError:  # optional, pip install lz4
+    lz4 = None
+
+# Lossless wire encodings of a stego carrier. Every one of them gives back the exact
+# same array, a single flipped LSB would corrupt the hidden message.
+
+SHAPE = struct.Struct('!B')  # number of dimensions, followed by one !I per dimension
+
+
+class CodecException(Exception):
+    pass
+
+
+def pack_array(image):  # Shape header and contiguous pixels of an 8 bit image
+    if image.dtype != np.uint8:
+        raise CodecException('Only 8 bit carriers can be encoded, got ' + str(image.dtype))
+    return SHAPE.pack(image.ndim) + struct.pack('!%dI' % image.ndim, *image.shape), np.ascontiguousarray(image)
+
+
+def split_array(data):  # Inverse of pack_array, returns the shape and a view of the pixel bytes
+    data = memoryview(data)
+    ndim = SHAPE.unpack_from(data)[0]
+    shape = struct.unpack_from('!%dI' % ndim, data, SHAPE.size)
+    return shape, data[SHAPE.size + 4 * ndim:]
+
+
+def to_image(pixels, shape):  # Writable image, never a view of the received buffer
+    return np.frombuffer(pixels, dtype=np.uint8).reshape(shape).copy()
+
+
+class RawCodec:
+    name = 'raw'
+
+    def encode(self, image):
+        header, image = pack_array(image)
+        return header + image.tobytes()
+
+    def decode(self, data):
+        shape, pixels = split_array(data)
+        return to_image(pixels, shape)
+
+
+class ZlibCodec:
+    name = 'zlib'
+    level = 6
+
+    def compress(self, pixels):
+        return zlib.compress(pixels, self.level)
+
+    def decompress(self, data):
+        return zlib.decompress(data)
+
+    def encode(self, image):
+        header, image = pack_array(image)
+        return header + self.compress(image)
+
+    def decode(self, data):
+        shape, pixels = split_array(data)
+        return to_image(self.decompress(pixels), shape)
+
+
+class Lz4Codec(ZlibCodec):
+    name = 'lz4'
+
+    def compress(self, pixels):
+        return lz4.frame.compress(pixels)
+
+    def decompress(self, data):
+        return lz4.frame.decompress(data)
+
+
+class PngCodec:
+    name = 'png'
+    level = 3  # zlib effort used by libpng, 9 is smaller but much slower
+
+    def encode(self, image):
+        if image.dtype != np.uint8:
+            raise CodecException('Only 8 bit carriers can be encoded, got ' + str(image.dtype))
+        ok, buf = cv2.imencode('.png', image, [cv2.IMWRITE_PNG_COMPRESSION, self.level])
+        if not ok:
+            raise CodecException('PNG encoding failed')
+        return buf.tobytes()
+
+    def decode(self, data):
+        image = cv2.imdecode(np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_UNCHANGED)
+        if image is None:
+            raise CodecException('PNG decoding failed')
+        return image
+
+
+CODECS = OrderedDict()  # available codecs, indexed by name, most preferred first
+for codec in (PngCodec(), Lz4Codec() if lz4 is not None else None, ZlibCodec(), RawCodec()):
+    if codec is not None:
+        CODECS[codec.name] = codec
+
+
+def available():
+    return list(CODECS.keys())
+
+
+def negotiate(offered, preference=None):
+    # First codec of our preference the other side also supports, raw is always understood
+    for name in preference or available():
+        if name in CODECS and name in offered:
+            return name
+    return RawCodec.name
+
+
+class CodecStats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}  # counters, indexed by codec name
+
+    def add(self, name, **values):
+        with self.lock:
+            c = self.counters.setdefault(name, {'encoded': 0, 'raw_bytes': 0, 'wire_bytes': 0,
+                                                'encode_seconds': 0.0, 'decoded': 0, 'decode_seconds': 0.0})
+            for key, value in values.items():
+                c[key] += value
+
+    def snapshot(self):
+        with self.lock:
+            out = {}
+            for name, c in self.counters.items():
+                c = dict(c)
+                c['saved_bytes'] = c['raw_bytes'] - c['wire_bytes']
+                out[name] = c
+            return out
+
+
+STATS = CodecStats()
+
+
+def encode(image, name):
+    start = time.perf_counter()
+    data = CODECS[name].encode(image)
+    STATS.add(name, encoded=1, raw_bytes=image.nbytes, wire_bytes=len(data),
+              encode_seconds=time.perf_counter() - start)
+    return data
+
+
+def decode(data, name):
+    if name not in CODECS:
+        raise CodecException('Unknown carrier codec ' + name)
+    start = time.perf_counter()
+    image = CODECS[name].decode(data)
+    STATS.add(name, decoded=1, decode_seconds=time.perf_counter() - start)
+    return image
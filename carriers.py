@@ -0,0 +1,104 @@
+#! /usr/bin/env python
+
+import hashlib
+import os
+import threading
+import time
+import cv2
+
+
+class CarrierCache(threading.Thread):
+    # Decoded carrier images kept in memory so no encode has to touch the disk. They are
+    # shared read-only, whoever hides something in one copies it first. The thread
+    # reloads a carrier when the mtime or size of its file changes, so stat() stays off
+    # the per-message path. Carriers are also registered by content hash, peers holding
+    # the same file refer to it by id instead of shipping the pixels.
+
+    def __init__(self, interval=2.0):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.interval = interval  # seconds between two checks of the files
+        self.lock = threading.Lock()
+        self.images = {}  # decoded images, indexed by path
+        self.stamps = {}  # (mtime, size) of the loaded file, indexed by path
+        self.paths = {}  # carrier id of the loaded file, indexed by path
+        self.known = {}  # every carrier version loaded so far, indexed by carrier id
+        self.hits = 0
+        self.misses = 0
+        self.reloads = 0
+
+    def load(self, path):  # Read and decode a carrier from disk, replacing the cached one
+        stat = os.stat(path)
+        image = cv2.imread(path)
+        if image is None:
+            raise IOError('Could not decode carrier ' + path)
+        image.setflags(write=False)
+        cid = carrier_id(image)
+        with self.lock:
+            self.images[path] = image
+            self.stamps[path] = (stat.st_mtime, stat.st_size)
+            self.paths[path] = cid
+            self.known[cid] = image  # older versions stay, deltas against them may still be in flight
+        return image
+
+    def preload(self, *paths):
+        for path in paths:
+            self.load(path)
+
+    def get(self, path):  # Shared read-only image, do not encode into it
+        with self.lock:
+            image = self.images.get(path)
+            if image is not None:
+                self.hits += 1
+                return image
+            self.misses += 1
+        return self.load(path)
+
+    def entry(self, path):  # (shared read-only image, carrier id), consistent even across a reload
+        with self.lock:
+            image = self.images.get(path)
+            if image is not None:
+                self.hits += 1
+                return image, self.paths[path]
+            self.misses += 1
+        image = self.load(path)
+        return image, carrier_id(image)
+
+    def find(self, cid):  # Shared read-only image registered under cid, None if unknown
+        with self.lock:
+            return self.known.get(cid)
+
+    def ids(self):
+        with self.lock:
+            return list(self.known.keys())
+
+    def refresh(self):  # Reload every carrier whose file changed since it was loaded
+        with self.lock:
+            stamps = dict(self.stamps)
+        for path, stamp in stamps.items():
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue  # keep serving the last good copy
+            if (stat.st_mtime, stat.st_size) != stamp:
+                try:
+                    self.load(path)
+                    self.reloads += 1
+                except Exception:
+                    continue
+
+    def stats(self):
+        with self.lock:
+            return {'carriers': len(self.images), 'versions': len(self.known), 'hits': self.hits,
+                    'misses': self.misses, 'reloads': self.reloads}
+
+    def run(self):
+        while True:
+            time.sleep(self.interval)
+            self.refresh()
+
+
+def carrier_id(image):  # Content hash of the decoded pixels, the same on every peer holding the file
+    digest = hashlib.sha256(str(image.shape).encode('ascii'))
+    digest.update(image.data if image.flags['C_CONTIGUOUS'] else image.tobytes())
+    return digest.hexdigest()[:32]
@@ -0,0 +1,367 @@
+#! /usr/bin/env python
+
+import errno
+import heapq
+import itertools
+import os
+import selectors
+import socket
+import threading
+import time
+import traceback
+from collections import deque
+from concurrent.futures import Future
+import protocol
+
+HIGH_WATER = 256 * 1024  # stop reading from a connection with this much output pending
+LOW_WATER = 64 * 1024  # and start again once it drained below this
+MAX_BUFFER = 8 * 1024 * 1024  # output pending beyond this triggers the overflow policy
+DISCONNECT = 'disconnect'  # overflow policy: the consumer is too slow, close it
+DROP = 'drop'  # overflow policy: refuse the new message, keep the connection
+IOV_MAX = 64  # buffers handed to one sendmsg() call
+SENDMSG = hasattr(socket.socket, 'sendmsg')
+
+
+class EventLoop:
+    # Single threaded reactor on top of selectors (epoll/kqueue when available).
+    # The loop sleeps in select() until a socket is ready, a timer is due or another
+    # thread hands it work through call_soon_threadsafe(), so an idle process uses no CPU.
+
+    def __init__(self):
+        self.selector = selectors.DefaultSelector()
+        self.ready = deque()  # (callback, args) to run on the next pass
+        self.timers = []  # heap of Timer
+        self.sequence = itertools.count()  # keeps the heap order stable for equal deadlines
+        self.lock = threading.Lock()  # guards ready against other threads
+        self.running = False
+        self.thread = None
+        self.on_iteration = None  # on_iteration(seconds) after every pass, with the time spent outside select()
+        self.waker, self.wakee = socket.socketpair()
+        self.waker.setblocking(False)
+        self.wakee.setblocking(False)
+        self.selector.register(self.wakee, selectors.EVENT_READ, self.drain_wakeups)
+
+    def call_soon(self, callback, *args):
+        with self.lock:
+            self.ready.append((callback, args))
+
+    def call_soon_threadsafe(self, callback, *args):
+        self.call_soon(callback, *args)
+        if threading.current_thread() is not self.thread:
+            try:
+                self.waker.send(b'\0')
+            except (BlockingIOError, OSError):
+                pass  # already a wakeup pending, or the loop is gone
+
+    def submit(self, callback, *args):  # Run callback on the loop from any thread, its result comes back as a Future
+        future = Future()
+
+        def run():
+            if not future.set_running_or_notify_cancel():
+                return
+            try:
+                future.set_result(callback(*args))
+            except BaseException as e:
+                future.set_exception(e)
+        self.call_soon_threadsafe(run)
+        return future
+
+    def call_later(self, delay, callback, *args):  # Loop thread only
+        timer = Timer(time.monotonic() + delay, next(self.sequence), callback, args)
+        heapq.heappush(self.timers, timer)
+        return timer
+
+    def drain_wakeups(self, mask):
+        try:
+            while self.wakee.recv(4096):
+                pass
+        except (BlockingIOError, OSError):
+            pass
+
+    def listen(self, sock, on_accept):  # on_accept(sock, addr) for every new connection
+        sock.setblocking(False)
+
+        def accept(mask):
+            while True:  # drain the backlog, several clients may be waiting
+                try:
+                    conn, addr = sock.accept()
+                except (BlockingIOError, InterruptedError):
+                    return
+                except OSError as e:
+                    if e.errno not in (errno.EINVAL, errno.EBADF):  # not just shut down or closed on exit
+                        traceback.print_exc()
+                    self.unlisten(sock)  # it would stay readable forever
+                    return
+                on_accept(conn, addr)
+        self.selector.register(sock, selectors.EVENT_READ, accept)
+
+    def unlisten(self, sock):
+        try:
+            self.selector.unregister(sock)
+        except (KeyError, ValueError):
+            pass
+
+    def timeout(self):
+        if self.ready:
+            return 0
+        if self.timers:
+            return max(0, self.timers[0].when - time.monotonic())
+        return None  # nothing to do until a socket wakes us up
+
+    def run_once(self):
+        events = self.selector.select(self.timeout())
+        start = time.perf_counter()
+        for key, mask in events:
+            try:
+                key.data(mask)
+            except Exception:
+                traceback.print_exc()
+        now = time.monotonic()
+        while self.timers and self.timers[0].when <= now:
+            timer = heapq.heappop(self.timers)
+            if not timer.cancelled:
+                self.call_soon(timer.callback, *timer.args)
+        with self.lock:
+            batch = list(self.ready)  # callbacks queued while running these wait for the next pass
+            self.ready.clear()
+        for callback, args in batch:
+            try:
+                callback(*args)
+            except Exception:
+                traceback.print_exc()
+        if self.on_iteration is not None:
+            self.on_iteration(time.perf_counter() - start)
+
+    def run_forever(self):
+        self.thread = threading.current_thread()
+        self.running = True
+        while self.running:
+            self.run_once()
+
+    def stop(self):
+        self.running = False
+        self.call_soon_threadsafe(lambda: None)
+
+
+class Timer:
+    def __init__(self, when, seq, callback, args):
+        self.when = when
+        self.seq = seq
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+
+    def __lt__(self, other):
+        return (self.when, self.seq) < (other.when, other.seq)
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class Connection:
+    # One framed, non-blocking socket registered on an EventLoop. Every complete frame
+    # is handed to on_message(conn, frame_type, payload), on_close(conn) runs once when
+    # the socket goes away. All methods must be called from the loop thread.
+    #
+    # Output is a queue of already serialized buffers, the same bytes object can sit in
+    # the queues of many connections. Past high_water the connection stops reading, so
+    # a client that does not read its answers cannot make us produce more of them, and
+    # past max_buffer the overflow policy decides between dropping and disconnecting.
+
+    high_water = HIGH_WATER
+    low_water = LOW_WATER
+    max_buffer = MAX_BUFFER
+    overflow = DISCONNECT
+
+    def __init__(self, loop, sock, on_message, on_close=None, connecting=False, **limits):
+        self.loop = loop
+        self.sock = sock
+        self.on_message = on_message
+        self.on_close = on_close
+        for name, value in limits.items():  # high_water, low_water, max_buffer, overflow
+            if not hasattr(Connection, name):
+                raise TypeError('Unknown connection limit ' + name)
+            setattr(self, name, value)
+        self.reader = protocol.FrameReader()
+        self.outq = deque()  # buffers accepted by send() the kernel did not take yet
+        self.offset = 0  # bytes of outq[0] already sent
+        self.buffered = 0  # bytes waiting in outq
+        self.paused = False  # reading stopped until the output drains below low_water
+        self.held = False  # reading stopped by hold(), until the work it fed is done
+        self.dropped = 0  # messages refused by the DROP policy
+        self.queued = 0  # bytes accepted by send() since the connection opened
+        self.sent = 0  # bytes the kernel took since the connection opened
+        self.received = 0  # bytes of the frames read since the connection opened
+        self.waiters = deque()  # (queued mark, on_sent callback), waiting for their bytes to leave
+        self.closed = False
+        self.closing = False  # close once outq is flushed
+        self.error = None  # why the connection went away, None for a clean close
+        self.connecting = connecting  # non-blocking connect() still in progress
+        self.events = selectors.EVENT_READ | (selectors.EVENT_WRITE if connecting else 0)
+        sock.setblocking(False)
+        loop.selector.register(sock, self.events, self.on_event)
+
+    @classmethod
+    def connect(cls, loop, address, on_message, on_close=None, **limits):
+        # Outgoing connection, does not block. address is (host, port), or the path of a
+        # Unix domain socket for a peer on the same host.
+        if isinstance(address, str):
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.setblocking(False)
+        else:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            sock.setblocking(False)
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        err = sock.connect_ex(address)
+        if err not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK):
+            sock.close()
+            raise OSError(err, os.strerror(err))
+        return cls(loop, sock, on_message, on_close, connecting=err != 0, **limits)
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def on_event(self, mask):
+        if self.connecting:
+            err = self.sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+            if err:
+                self.close(error=OSError(err, os.strerror(err)))
+                return
+            self.connecting = False
+            self.flush()
+        if mask & selectors.EVENT_READ and not self.closed and not self.paused and not self.held:
+            self.on_readable()
+        if mask & selectors.EVENT_WRITE and not self.closed:
+            self.flush()
+
+    def on_readable(self):
+        try:
+            frames = self.reader.recv(self.sock)
+        except (BlockingIOError, InterruptedError):
+            return
+        except protocol.ProtocolError as e:
+            traceback.print_exc()
+            self.close(error=e)
+            return
+        except OSError as e:
+            self.close(error=e)
+            return
+        if frames is None:
+            self.close()
+            return
+        for frame_type, payload in frames:
+            if self.closed:
+                break
+            self.received += protocol.HEADER.size + len(payload)
+            self.on_message(self, frame_type, payload)
+
+    def send(self, data, on_sent=None):
+        # Queue one serialized message, data is not copied so it must not change afterwards.
+        # on_sent(error) runs once the kernel took the whole of data, or with the error
+        # that closed the connection or made the overflow policy refuse it.
+        # Returns False when the message will not be sent.
+        if self.closed or self.closing:
+            if on_sent is not None:
+                on_sent(self.error or ConnectionError('Connection closed'))
+            return False
+        if self.buffered + len(data) > self.max_buffer:
+            error = BufferError('Output buffer full, consumer too slow')
+            if self.overflow == DROP:
+                self.dropped += 1
+                if on_sent is not None:
+                    on_sent(error)
+            else:
+                if on_sent is not None:
+                    on_sent(error)
+                self.close(error=error)
+            return False
+        if not data:
+            if on_sent is not None:
+                on_sent(None)
+            return True
+        self.outq.append(data)
+        self.buffered += len(data)
+        self.queued += len(data)
+        if on_sent is not None:
+            self.waiters.append((self.queued, on_sent))
+        self.flush()
+        return True
+
+    def pending(self):  # Buffers for the next write, the first one past what was already sent
+        if not SENDMSG:
+            return memoryview(self.outq[0])[self.offset:]
+        views = [memoryview(self.outq[0])[self.offset:]]
+        for i in range(1, min(len(self.outq), IOV_MAX)):
+            views.append(self.outq[i])
+        return views
+
+    def consume(self, n):  # Forget the n bytes the kernel just took
+        self.sent += n
+        self.buffered -= n
+        n += self.offset
+        while self.outq and n >= len(self.outq[0]):
+            n -= len(self.outq.popleft())
+        self.offset = n
+
+    def flush(self):
+        if self.connecting:
+            return  # on_event flushes once the connection is established
+        while self.outq:
+            try:
+                if SENDMSG:
+                    n = self.sock.sendmsg(self.pending())
+                else:
+                    n = self.sock.send(self.pending())
+            except (BlockingIOError, InterruptedError):
+                break
+            except OSError as e:
+                self.close(error=e)
+                return
+            self.consume(n)
+        while self.waiters and self.waiters[0][0] <= self.sent:
+            self.waiters.popleft()[1](None)
+        if self.closed:
+            return  # one of the callbacks closed us
+        if not self.outq and self.closing:
+            self.close()
+            return
+        if self.paused and self.buffered <= self.low_water:
+            self.paused = False
+        elif not self.paused and self.buffered > self.high_water:
+            self.paused = True
+        self.update_events()
+
+    def hold(self, held):  # Stop or resume reading whatever the output watermarks say
+        self.held = held
+        self.update_events()
+
+    def update_events(self):
+        events = 0 if self.paused or self.held else selectors.EVENT_READ
+        if self.outq or self.connecting:
+            events |= selectors.EVENT_WRITE
+        if events != self.events and not self.closed:
+            self.events = events
+            self.loop.selector.modify(self.sock, events, self.on_event)
+
+    def close(self, flush=False, error=None):  # flush: send what is already queued first
+        if self.closed:
+            return
+        if flush and self.outq and error is None:
+            self.closing = True
+            return
+        self.closed = True
+        self.error = error
+        self.outq.clear()
+        self.buffered = 0
+        try:
+            self.loop.selector.unregister(self.sock)
+        except (KeyError, ValueError):
+            pass
+        try:
+            self.sock.close()
+        except OSError:
+            pass
+        while self.waiters:
+            self.waiters.popleft()[1](error or ConnectionError('Connection closed'))
+        if self.on_close is not None:
+            self.on_close(self)
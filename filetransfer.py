@@ -0,0 +1,142 @@
+#! /usr/bin/env python
+
+import hashlib
+import os
+import time
+import zlib
+
+# Files are sent as a stream of FILE messages, each hiding one chunk in its own carrier.
+# Msg.file describes the chunk: {'id', 'name', 'seq', 'last', 'crc32', 'sha256'}, the
+# sha256 of the whole file only comes with the last chunk. Both sides only ever hold
+# a few chunks, whatever the size of the file.
+
+DOWNLOAD_DIR = 'downloads'
+MAX_PENDING = 16  # chunks that arrived ahead of a missing one, kept per transfer
+IDLE_TIMEOUT = 120  # seconds without a chunk before an incoming transfer is given up
+
+
+class FileTransferError(Exception):
+    pass
+
+
+def read_chunks(file, size):
+    # (seq, data, last) for every chunk of size bytes read from file, one read ahead so the
+    # last chunk is known when it is yielded. An empty file still gives one empty chunk.
+    seq = 0
+    data = file.read(size)
+    while True:
+        following = file.read(size)
+        yield seq, data, not following
+        if not following:
+            return
+        seq += 1
+        data = following
+
+
+def describe(chunks, transfer_id, name):  # (chunk info for Msg.file, data) for every chunk
+    digest = hashlib.sha256()
+    for seq, data, last in chunks:
+        digest.update(data)
+        info = {'id': transfer_id, 'name': name, 'seq': seq, 'last': last,
+                'crc32': zlib.crc32(data), 'sha256': digest.hexdigest() if last else ''}
+        yield info, data
+
+
+class Transfer:
+    def __init__(self, directory, sender, info):
+        name = safe_name(sender, 'someone') + '-' + safe_name(info['name'], 'file')
+        self.path = unique_path(os.path.join(directory, name))
+        self.part = self.path + '.part'
+        self.file = open(self.part, 'wb')
+        self.next = 0  # seq of the next chunk to write
+        self.pending = {}  # data of the chunks that came early, indexed by seq
+        self.digest = hashlib.sha256()
+        self.size = 0
+        self.touched = time.monotonic()
+
+    def write(self, info, data):
+        # Write the chunk and the early ones it unblocks. Returns the sha256 announced with
+        # the last chunk once it is on disk, None while more are expected.
+        while True:
+            self.file.write(data)
+            self.digest.update(data)
+            self.size += len(data)
+            self.next += 1
+            if info['last']:
+                return info['sha256']
+            if self.next not in self.pending:
+                return None
+            info, data = self.pending.pop(self.next)
+
+    def finish(self, expected):
+        self.file.close()
+        if self.digest.hexdigest() != expected:
+            os.remove(self.part)
+            raise FileTransferError('Checksum of ' + self.path + ' does not match, file discarded')
+        os.replace(self.part, self.path)
+
+    def abort(self):
+        self.file.close()
+        try:
+            os.remove(self.part)
+        except OSError:
+            pass
+
+
+class FileReceiver:
+    # Reassembles incoming transfers straight into files under directory, chunk by chunk.
+
+    def __init__(self, directory=DOWNLOAD_DIR):
+        self.directory = directory
+        self.transfers = {}  # Transfer, indexed by (sender, transfer id)
+
+    def receive(self, sender, info, data):
+        # Returns the path of the file once it is complete, None while more chunks are expected
+        if zlib.crc32(data) != info['crc32']:
+            self.drop((sender, info['id']))
+            raise FileTransferError('Chunk %d of %s is corrupted, transfer aborted' % (info['seq'], info['name']))
+        key = (sender, info['id'])
+        transfer = self.transfers.get(key)
+        if transfer is None:
+            self.expire()
+            os.makedirs(self.directory, exist_ok=True)
+            transfer = self.transfers[key] = Transfer(self.directory, sender, info)
+        transfer.touched = time.monotonic()
+        if info['seq'] < transfer.next:
+            return None  # already written, sent twice after a retry
+        if info['seq'] > transfer.next:
+            if len(transfer.pending) >= MAX_PENDING:
+                self.drop(key)
+                raise FileTransferError('Too many chunks of %s missing, transfer aborted' % info['name'])
+            transfer.pending[info['seq']] = (info, data)
+            return None
+        expected = transfer.write(info, data)
+        if expected is None:
+            return None
+        del self.transfers[key]
+        transfer.finish(expected)
+        return transfer.path
+
+    def drop(self, key):
+        transfer = self.transfers.pop(key, None)
+        if transfer is not None:
+            transfer.abort()
+
+    def expire(self):  # Give up on transfers whose sender went quiet
+        now = time.monotonic()
+        for key, transfer in list(self.transfers.items()):
+            if now - transfer.touched > IDLE_TIMEOUT:
+                self.drop(key)
+
+
+def safe_name(name, default):  # Last path component only, a peer must not pick where we write
+    return os.path.basename(name.replace('\\', '/')).strip() or default
+
+
+def unique_path(path):  # path, or path with a number added when the file already exists
+    base, ext = os.path.splitext(path)
+    n = 1
+    while os.path.exists(path) or os.path.exists(path + '.part'):
+        path = '%s (%d)%s' % (base, n, ext)
+        n += 1
+    return path
@@ -0,0 +1,338 @@
+#! /usr/bin/env python
+
+# Load generator for PServer. Starts a server on a local port, in a scratch directory so
+# it gets an empty user store, then drives many synthetic clients from a single event
+# loop: REG (or LOGIN when the name exists), FTCH and relayed DMSG/AMSG at a given rate
+# and mix, then BYE. Reports connection setup time, auth round trips, presence fan-out
+# latency, request round trips and the server's CPU and memory over time.
+#
+#   python loadgen.py --clients 500 --rate 100 --duration 20 --mix ftch=1,dmsg=4,amsg=1
+#   python loadgen.py --server 127.0.0.1:5535 ...   drive a server that is already running
+
+import argparse
+import json
+import os
+import random
+import resource
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from collections import deque
+import numpy as np
+import eventloop
+import protocol
+from protocol import Msg
+
+SERVER_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'PServer.py')
+PAYLOAD_SIZE = 2048  # bytes of the synthetic carrier sent in every DMSG/AMSG
+AMSG_FANOUT = 8  # recipients of one AMSG, relayed to each of them like the client does for unreachable peers
+
+
+class Recorder:
+    def __init__(self):
+        self.samples = {}  # seconds, indexed by metric name
+        self.counters = {}
+
+    def add(self, name, value):
+        self.samples.setdefault(name, []).append(value)
+
+    def count(self, name, n=1):
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    def report(self):
+        out = {'counters': dict(self.counters), 'latency': {}}
+        for name, values in sorted(self.samples.items()):
+            v = np.array(values)
+            out['latency'][name] = {'count': len(values), 'mean_ms': float(v.mean() * 1000),
+                                    'p50_ms': float(np.percentile(v, 50) * 1000),
+                                    'p90_ms': float(np.percentile(v, 90) * 1000),
+                                    'p99_ms': float(np.percentile(v, 99) * 1000),
+                                    'max_ms': float(v.max() * 1000)}
+        return out
+
+
+class SimClient:
+    # One synthetic user on its own server connection. Requests are answered in order,
+    # so the start time of each one waits in a queue until its answer comes back.
+
+    def __init__(self, gen, index):
+        self.gen = gen
+        self.name = '%s%d' % (gen.prefix, index)
+        self.password = 'pw' + self.name
+        self.conn = None
+        self.waiting = deque()  # (answer type, metric, start time) of the requests sent
+        self.online = False
+        self.snapshot = False  # the ULST that follows a successful login is not a request answer
+        self.timer = None
+
+    def start(self):
+        started = time.monotonic()
+        try:
+            self.conn = eventloop.Connection.connect(self.gen.loop, self.gen.address, self.on_message, self.on_close)
+        except OSError:
+            self.gen.rec.count('connect_failed')
+            return
+        self.gen.rec.count('connections')
+        self.authenticate('REG', lambda error: error is None and self.gen.rec.add('connect', time.monotonic() - started))
+
+    def authenticate(self, type, on_sent=None):
+        msg = Msg()
+        msg.type = type
+        msg.name = self.name
+        msg.password = self.password
+        msg.port = 0
+        self.gen.auth_sent[self.name] = time.monotonic()
+        self.request(msg, 'AUTH', 'auth_' + type.lower(), on_sent)
+
+    def request(self, msg, answer, metric, on_sent=None):
+        self.waiting.append((answer, metric, time.monotonic()))
+        self.conn.send(protocol.pack(msg), on_sent)
+        self.gen.rec.count('sent_' + msg.type)
+
+    def on_message(self, conn, frame_type, payload):
+        now = time.monotonic()
+        msg = protocol.unpack(payload)
+        rec = self.gen.rec
+        rec.count('received_' + msg.type)
+        if msg.type in ('JOIN', 'LEAVE'):
+            sent = self.gen.auth_sent.get(msg.name) if msg.type == 'JOIN' else self.gen.bye_sent.get(msg.name)
+            if sent is not None:
+                rec.add('fanout_' + msg.type.lower(), now - sent)
+            return
+        if msg.type in ('DMSG', 'AMSG'):
+            return  # relayed to us by another synthetic client
+        if msg.type == 'ULST' and self.snapshot:
+            self.snapshot = False
+            return
+        if not self.waiting:
+            rec.count('unexpected_' + msg.type)
+            return
+        answer, metric, started = self.waiting.popleft()
+        rec.add(metric, now - started)
+        if answer == 'AUTH':
+            if msg.type == 'OK':
+                self.online = True
+                self.snapshot = True
+                self.schedule()
+            elif metric == 'auth_reg':
+                self.authenticate('LOGIN')  # left over from an earlier run against the same server
+            else:
+                rec.count('auth_failed')
+        elif msg.type == 'RNAK':
+            rec.count('relay_refused')
+
+    def on_close(self, conn):
+        if self.timer is not None:
+            self.timer.cancel()
+        if self.online and not self.gen.stopping:
+            self.gen.rec.count('dropped_by_server')
+        self.online = False
+
+    def schedule(self):
+        if self.gen.msg_rate > 0 and not self.gen.stopping:
+            self.timer = self.gen.loop.call_later(random.expovariate(self.gen.msg_rate), self.act)
+
+    def act(self):
+        if not self.online or self.gen.stopping:
+            return
+        op = random.choices(self.gen.ops, self.gen.weights)[0]
+        if op == 'ftch':
+            msg = Msg()
+            msg.type = 'FTCH'
+            msg.name = self.name
+            self.request(msg, 'ULST', 'ftch')
+        else:
+            count = 1 if op == 'dmsg' else AMSG_FANOUT
+            for user in self.gen.pick(count, self.name):
+                msg = Msg()
+                msg.type = 'RELAY'
+                msg.name = self.name
+                msg.to = user
+                msg.msg = self.gen.frames[op]
+                self.request(msg, 'RACK', 'relay_' + op)
+        self.schedule()
+
+    def stop(self):
+        if self.conn is None or self.conn.closed:
+            return
+        if self.online:
+            msg = Msg()
+            msg.type = 'BYE'
+            msg.name = self.name
+            self.gen.bye_sent[self.name] = time.monotonic()
+            self.conn.send(protocol.pack(msg))  # the server closes the connection
+        else:
+            self.conn.close()
+
+
+class LoadGenerator:
+    def __init__(self, args, address):
+        self.loop = eventloop.EventLoop()
+        self.address = address
+        self.rec = Recorder()
+        self.prefix = args.prefix
+        self.msg_rate = args.msg_rate
+        mix = dict((k, float(v)) for k, v in (part.split('=') for part in args.mix.split(',')))
+        self.ops = [op for op in ('ftch', 'dmsg', 'amsg') if mix.get(op, 0) > 0]
+        self.weights = [mix[op] for op in self.ops]
+        self.frames = {op: self.inner_frame(op.upper()) for op in ('dmsg', 'amsg')}
+        self.clients = [SimClient(self, i) for i in range(args.clients)]
+        self.auth_sent = {}  # when each user sent its REG/LOGIN, for the JOIN fan-out latency
+        self.bye_sent = {}  # when each user sent its BYE, for the LEAVE fan-out latency
+        self.stopping = False
+
+    def inner_frame(self, type):  # A framed message like the ones clients relay, built once
+        msg = Msg()
+        msg.type = type
+        msg.name = self.prefix
+        msg.codec = 'raw'
+        msg.msg = os.urandom(PAYLOAD_SIZE)
+        return protocol.pack(msg)
+
+    def pick(self, count, exclude):  # Random online recipients
+        online = [c.name for c in random.sample(self.clients, min(len(self.clients), count + 1))
+                  if c.online and c.name != exclude]
+        return online[:count]
+
+
+class ProcessMonitor:
+    # CPU and resident memory of a process and its children (the workers of a multi-worker
+    # server) over time, read from /proc (Linux)
+
+    def __init__(self, pid):
+        self.pid = pid
+        self.samples = []  # (seconds since start, cpu percent, rss bytes)
+        self.start = time.monotonic()
+        self.last = None
+
+    def pids(self):
+        try:
+            with open('/proc/%d/task/%d/children' % (self.pid, self.pid)) as file:
+                return [self.pid] + [int(pid) for pid in file.read().split()]
+        except OSError:
+            return [self.pid]
+
+    def cpu_seconds(self, pid):
+        with open('/proc/%d/stat' % pid) as file:
+            fields = file.read().rsplit(')', 1)[1].split()
+        return (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')  # utime + stime
+
+    def rss(self, pid):
+        with open('/proc/%d/status' % pid) as file:
+            for line in file:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) * 1024
+        return 0
+
+    def sample(self):
+        try:
+            pids = self.pids()
+            now = time.monotonic()
+            cpu = sum(self.cpu_seconds(pid) for pid in pids)
+            rss = sum(self.rss(pid) for pid in pids)
+        except (OSError, IndexError, ValueError):
+            return
+        if self.last is not None:
+            percent = 100 * (cpu - self.last[1]) / max(now - self.last[0], 1e-9)
+            self.samples.append((round(now - self.start, 2), round(percent, 1), rss))
+        self.last = (now, cpu)
+
+
+def start_server(port, metrics_port, workdir, workers=1):
+    log = open(os.path.join(workdir, 'server.log'), 'w')
+    proc = subprocess.Popen([sys.executable, '-u', SERVER_SCRIPT, str(port), str(metrics_port), str(workers)], cwd=workdir,
+                            stdout=log, stderr=subprocess.STDOUT)
+    deadline = time.monotonic() + 10
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=0.2).close()
+            return proc
+        except OSError:
+            if proc.poll() is not None:
+                break
+            time.sleep(0.1)
+    proc.kill()
+    raise RuntimeError('Server did not start, see ' + log.name)
+
+
+def raise_fd_limit():  # Every synthetic client holds a socket
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Synthetic client load for PServer')
+    parser.add_argument('--clients', type=int, default=200, help='synthetic users')
+    parser.add_argument('--rate', type=float, default=50, help='new clients per second while ramping up')
+    parser.add_argument('--duration', type=float, default=10, help='seconds of traffic once every client started')
+    parser.add_argument('--msg-rate', type=float, default=0.5, help='requests per second of each client')
+    parser.add_argument('--mix', default='ftch=1,dmsg=4,amsg=1', help='relative weight of each request type')
+    parser.add_argument('--server', help='host:port of a running server, otherwise one is started')
+    parser.add_argument('--port', type=int, default=15535, help='port of the server started by the generator')
+    parser.add_argument('--metrics-port', type=int, default=0, help='metrics endpoint of that server, 0 for none')
+    parser.add_argument('--workers', type=int, default=1, help='worker processes of the server started by the generator')
+    parser.add_argument('--prefix', default='load', help='synthetic usernames start with this')
+    parser.add_argument('--sample', type=float, default=1.0, help='seconds between two server CPU/memory samples')
+    parser.add_argument('--out', help='write the report to this JSON file')
+    args = parser.parse_args()
+
+    raise_fd_limit()
+    workdir = proc = monitor = None
+    if args.server:
+        host, port = args.server.rsplit(':', 1)
+        address = (host, int(port))
+    else:
+        workdir = tempfile.mkdtemp(prefix='pserver-load-')
+        proc = start_server(args.port, args.metrics_port, workdir, args.workers)
+        monitor = ProcessMonitor(proc.pid)
+        address = ('127.0.0.1', args.port)
+
+    gen = LoadGenerator(args, address)
+    loop = gen.loop
+    ramp = len(gen.clients) / args.rate if args.rate > 0 else 0
+    for i, client in enumerate(gen.clients):
+        loop.call_later(i / args.rate if args.rate > 0 else 0, client.start)
+    if monitor is not None:
+        def sample():
+            monitor.sample()
+            loop.call_later(args.sample, sample)
+        sample()
+
+    def stop():
+        gen.stopping = True
+        for client in gen.clients:
+            client.stop()
+        loop.call_later(2, loop.stop)  # let the LEAVE deltas arrive before the server goes away
+    loop.call_later(ramp + args.duration, stop)
+    started = time.monotonic()
+    try:
+        loop.run_forever()
+    finally:
+        if proc is not None:
+            proc.terminate()
+            proc.wait()
+    report = gen.rec.report()
+    report['seconds'] = round(time.monotonic() - started, 2)
+    report['clients'] = args.clients
+    if monitor is not None:
+        report['server'] = monitor.samples
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    for name, value in sorted(report['counters'].items()):
+        print('%-24s %d' % (name, value))
+    for name, s in report['latency'].items():
+        print('%-24s n=%-7d p50 %8.2f ms  p90 %8.2f ms  p99 %8.2f ms  max %8.2f ms'
+              % (name, s['count'], s['p50_ms'], s['p90_ms'], s['p99_ms'], s['max_ms']))
+    for t, cpu, rss in report.get('server', []):
+        print('server t=%6.1fs cpu %5.1f%% rss %6.1f MB' % (t, cpu, rss / 1e6))
+    if args.out:
+        with open(args.out, 'w') as file:
+            json.dump(report, file, indent=1)
+
+
+if __name__ == '__main__':
+    main()
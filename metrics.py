@@ -0,0 +1,160 @@
+#! /usr/bin/env python
+
+import bisect
+import selectors
+import threading
+import traceback
+
+# Latency buckets in seconds, from 50 us to 2.5 s
+BUCKETS = (0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+MAX_REQUEST = 8192  # bytes of HTTP request read before giving up on a scraper
+
+
+class Histogram:
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # the last one is +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative(self):  # (upper bound, observations at or below it), +Inf last
+        out = []
+        total = 0
+        for bound, n in zip(list(self.buckets) + ['+Inf'], self.counts):
+            total += n
+            out.append((bound, total))
+        return out
+
+
+class Registry:
+    # Counters, histograms and collected values of one process, rendered in the Prometheus
+    # text format or as a plain dict. Collected values are callbacks asked at render time,
+    # so a queue length costs nothing until somebody looks at it. A callback returns a
+    # number, or a list of (labels, number) for one series per label set.
+
+    def __init__(self, prefix):
+        self.prefix = prefix
+        self.lock = threading.Lock()
+        self.counters = {}  # value, indexed by name then by sorted label items
+        self.histograms = {}  # Histogram, indexed by name then by sorted label items
+        self.collectors = {}  # (kind, callback), indexed by name
+
+    def inc(self, name, value=1, **labels):
+        with self.lock:
+            series = self.counters.setdefault(name, {})
+            key = tuple(sorted(labels.items()))
+            series[key] = series.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        with self.lock:
+            series = self.histograms.setdefault(name, {})
+            key = tuple(sorted(labels.items()))
+            histogram = series.get(key)
+            if histogram is None:
+                histogram = series[key] = Histogram()
+            histogram.observe(value)
+
+    def collect(self, name, callback, kind='gauge'):
+        self.collectors[name] = (kind, callback)
+
+    def collected(self):  # {name: (kind, [(label items, value)])}, callbacks run outside the lock
+        out = {}
+        for name, (kind, callback) in list(self.collectors.items()):
+            value = callback()
+            if isinstance(value, list):
+                out[name] = (kind, [(tuple(sorted(labels.items())), v) for labels, v in value])
+            else:
+                out[name] = (kind, [((), value)])
+        return out
+
+    def snapshot(self):  # Plain dict of every series, small enough to pickle into a STATS reply
+        collected = self.collected()
+        with self.lock:
+            out = {}
+            for name, series in self.counters.items():
+                out[name] = {label_text(key): value for key, value in series.items()}
+            for name, series in self.histograms.items():
+                out[name] = {label_text(key): {'count': h.count, 'sum': h.sum,
+                                               'buckets': [(str(b), n) for b, n in h.cumulative()]}
+                             for key, h in series.items()}
+        for name, (kind, series) in collected.items():
+            out[name] = {label_text(key): value for key, value in series}
+        return out
+
+    def render(self):  # Prometheus text exposition format
+        collected = self.collected()
+        lines = []
+        with self.lock:
+            for name, series in sorted(self.counters.items()):
+                full = self.prefix + '_' + name
+                lines.append('# TYPE %s counter' % full)
+                for key, value in sorted(series.items()):
+                    lines.append('%s%s %s' % (full, label_text(key), value))
+            for name, series in sorted(self.histograms.items()):
+                full = self.prefix + '_' + name
+                lines.append('# TYPE %s histogram' % full)
+                for key, h in sorted(series.items()):
+                    for bound, n in h.cumulative():
+                        lines.append('%s_bucket%s %d' % (full, label_text(key + (('le', str(bound)),)), n))
+                    lines.append('%s_sum%s %r' % (full, label_text(key), h.sum))
+                    lines.append('%s_count%s %d' % (full, label_text(key), h.count))
+        for name, (kind, series) in sorted(collected.items()):
+            full = self.prefix + '_' + name
+            lines.append('# TYPE %s %s' % (full, kind))
+            for key, value in sorted(series):
+                lines.append('%s%s %s' % (full, label_text(key), value))
+        return '\n'.join(lines) + '\n'
+
+
+def label_text(key):  # {a="1",b="2"} from sorted label items, empty without labels
+    if not key:
+        return ''
+    return '{' + ','.join('%s="%s"' % (k, str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+                          for k, v in key) + '}'
+
+
+def serve_http(loop, sock, render):
+    # Answer every HTTP request on the listening sock with render(), from the event loop.
+    # Enough for a Prometheus scraper or curl, nothing more.
+
+    def accept(conn, addr):
+        conn.setblocking(False)
+        state = {'request': b'', 'response': None}
+
+        def close():
+            loop.selector.unregister(conn)
+            conn.close()
+
+        def on_event(mask):
+            try:
+                if state['response'] is None:
+                    data = conn.recv(4096)
+                    if not data:
+                        close()
+                        return
+                    state['request'] += data
+                    if b'\r\n\r\n' not in state['request'] and len(state['request']) < MAX_REQUEST:
+                        return
+                    body = render().encode('utf-8')
+                    state['response'] = memoryview(
+                        b'HTTP/1.0 200 OK\r\nContent-Type: text/plain; version=0.0.4\r\n'
+                        b'Content-Length: ' + str(len(body)).encode('ascii') + b'\r\nConnection: close\r\n\r\n' + body)
+                    loop.selector.modify(conn, selectors.EVENT_WRITE, on_event)
+                n = conn.send(state['response'])
+                state['response'] = state['response'][n:]
+                if not state['response']:
+                    close()
+            except (BlockingIOError, InterruptedError):
+                pass
+            except OSError:
+                close()
+            except Exception:
+                traceback.print_exc()
+                close()
+        loop.selector.register(conn, selectors.EVENT_READ, on_event)
+    loop.listen(sock, accept)
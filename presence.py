@@ -0,0 +1,118 @@
+#! /usr/bin/env python
+
+import eventloop
+import protocol
+from protocol import Msg
+
+# Output limits of the link between the broker and a worker, on both ends. Relayed carriers
+# go through it both ways, so neither end may stop reading while its own output backs up:
+# with both ends waiting for the other to read, the link would never move again. The
+# watermarks sit at max_buffer, which send() never lets the output go past.
+LINK_BUFFER = 16 * protocol.MAX_FRAME
+LINK_LIMITS = {'max_buffer': LINK_BUFFER, 'high_water': LINK_BUFFER, 'low_water': LINK_BUFFER}
+
+
+class Broker:
+    # Presence shared by the worker processes of a multi-worker PServer, run by the parent.
+    # Workers ask it before logging a user in, so a name is online on one worker at most.
+    # Every JOIN/LEAVE is numbered here and goes to every worker, which applies it to its
+    # copy of the user list and passes it on, so clients see the same sequence numbers
+    # whatever worker they landed on. Relays to a user of another worker go through here
+    # too, and the ones for offline users are queued on disk here, the only place that
+    # knows for sure that they are offline.
+    #
+    # Worker to broker: CLAIM name port local, answered OK or FAIL once the JOIN went out.
+    #                   RELEASE name.
+    #                   FWD to msg (a frame), answered RACK or RNAK.
+    # Broker to worker: JOIN/LEAVE deltas, DLVR to msg for a user the worker holds,
+    #                   and the answers, in the order of the requests.
+
+    def __init__(self, loop, store, relay_queue, max_message):
+        self.loop = loop
+        self.store = store
+        self.relay_queue = relay_queue
+        self.max_message = max_message  # largest frame a client connection takes, see Server.relay
+        self.workers = set()  # eventloop.Connection to every live worker
+        self.owners = {}  # worker connection holding the user, indexed by username
+        self.ports = {}  # ports of the online users, indexed by username
+        self.locals = {}  # same host addresses of the online users that have one, indexed by username
+        self.seq = 0
+
+    def add_worker(self, sock):
+        self.workers.add(eventloop.Connection(self.loop, sock, self.handle, self.closed, **LINK_LIMITS))
+
+    def closed(self, conn):  # A worker died, its users are gone with it
+        self.workers.discard(conn)
+        print('Worker link closed', conn.error or '')
+        for name in [name for name, owner in self.owners.items() if owner is conn]:
+            self.release(name)
+
+    def publish(self, type, name, port, local=None):
+        self.seq += 1
+        msg = Msg()
+        msg.type = type
+        msg.name = name
+        msg.port = port
+        msg.local = local
+        msg.seq = self.seq
+        data = protocol.pack(msg)  # serialized once for every worker
+        for worker in self.workers:
+            worker.send(data)
+
+    def release(self, name):
+        del self.owners[name]
+        del self.ports[name]
+        self.locals.pop(name, None)
+        self.publish('LEAVE', name, None)
+
+    def claim(self, conn, msg):
+        answer = Msg()
+        if msg.name in self.owners:
+            answer.type = 'FAIL'
+            answer.msg = 'Invalid username/password'
+            return answer
+        self.owners[msg.name] = conn
+        self.ports[msg.name] = msg.port
+        if msg.local:
+            self.locals[msg.name] = msg.local
+        self.publish('JOIN', msg.name, msg.port, msg.local)  # reaches the claiming worker before the OK
+        answer.type = 'OK'
+        return answer
+
+    def forward(self, msg):  # Same outcomes as Server.relay, for a user no worker of the sender holds
+        answer = Msg()
+        answer.type = 'RNAK'
+        answer.name = msg.to
+        owner = self.owners.get(msg.to)
+        delivery = Msg()
+        delivery.type = 'DLVR'
+        delivery.to = msg.to
+        delivery.msg = msg.msg
+        if len(msg.msg) > self.max_message:
+            answer.msg = 'Message too large for ' + msg.to
+        elif owner is not None and owner.send(protocol.pack(delivery)):
+            answer.type = 'RACK'
+            answer.msg = 'Relayed to ' + msg.to
+        elif not self.store.exists(msg.to):
+            answer.msg = 'Unknown user ' + msg.to
+        elif self.relay_queue.append(msg.to, msg.msg):
+            answer.type = 'RACK'
+            answer.msg = 'Queued for ' + msg.to
+        else:
+            answer.msg = 'Too many messages waiting for ' + msg.to
+        return answer
+
+    def handle(self, conn, frame_type, payload):
+        msg = protocol.unpack(payload)
+        if msg.type == 'CLAIM':
+            conn.send(protocol.pack(self.claim(conn, msg)))
+        elif msg.type == 'RELEASE':
+            if self.owners.get(msg.name) is conn:
+                self.release(msg.name)
+        elif msg.type == 'FWD':
+            conn.send(protocol.pack(self.forward(msg)))
+        else:
+            print('Unknown broker message', msg.type)
+
+    def stats(self):
+        return {'workers': len(self.workers), 'online': len(self.owners), 'seq': self.seq}
@@ -0,0 +1,203 @@
+#! /usr/bin/env python
+
+import copy
+import pickle
+import struct
+import threading
+import time
+import numpy as np
+import carrier_codecs
+import tracing
+
+# Every message on a socket is sent as one frame:
+#   version (1 byte) | frame type (1 byte) | reserved (2 bytes) | payload length (4 bytes) | payload
+VERSION = 1
+HEADER = struct.Struct('!BBHI')
+FRAME_MSG = 1  # payload is a pickled Msg
+MAX_FRAME = 64 * 1024 * 1024  # refuse anything bigger, a corrupted length would allocate gigabytes
+RECV_SIZE = 65536
+
+
+class ProtocolError(Exception):
+    pass
+
+
+class CarrierMissing(ProtocolError):
+    pass  # a delta refers to a carrier this side does not hold
+
+
+class Msg:
+    name = ''  # sender name
+    port = 0  # used in authenticatiom
+    pub_key = ''  # used in authenticatiom
+    type = ''  # type of message
+    msg = ''  # content of the message
+    password = ''  # used in authentication
+    codec = ''  # carrier_codecs name msg is encoded with, empty when msg is not a carrier
+    carrier_id = ''  # when set, msg only holds the bytes that differ from this shared carrier
+    offset = 0  # position of those bytes in the flattened carrier
+    seq = 0  # presence sequence number of ULST snapshots and JOIN/LEAVE deltas
+    local = None  # same host address of a client, {'host', 'path'} of its Unix socket, per username in a ULST
+    to = ''  # recipient of a message relayed through the server
+    steg_bits = 0  # LSBs per channel the carrier was encoded with, 0 for LSBSteg's default layout
+    steg_keyed = False  # payload scattered in the slot order of the sender's key, see PClient.steg_key
+    file = None  # chunk description of a FILE message, see filetransfer
+    sealed = None  # nonce, tag and per recipient keys of an encrypted payload, see sessions.seal
+    trace = None  # tracing stamps of the pipeline stages, None when the message is not traced
+
+    def set_carrier(self, image, codec):
+        self.msg = carrier_codecs.encode(image, codec)
+        self.codec = codec
+
+    def set_delta(self, image, base, cid):
+        # Keep only the span of bytes where image differs from the carrier both sides hold
+        start = time.perf_counter()
+        changed = np.flatnonzero(image.reshape(-1) != base.reshape(-1))
+        if changed.size:
+            self.offset = int(changed[0])
+            self.msg = image.reshape(-1)[self.offset:int(changed[-1]) + 1].tobytes()
+        else:
+            self.offset = 0
+            self.msg = b''
+        self.carrier_id = cid
+        self.codec = ''
+        carrier_codecs.STATS.add('delta', encoded=1, raw_bytes=image.nbytes, wire_bytes=len(self.msg),
+                                 encode_seconds=time.perf_counter() - start)
+
+    def carrier(self, registry=None):  # The stego image carried by the message
+        if self.carrier_id:
+            base = registry.find(self.carrier_id) if registry is not None else None
+            if base is None:
+                raise CarrierMissing('Unknown carrier ' + self.carrier_id)
+            start = time.perf_counter()
+            image = base.copy()
+            delta = np.frombuffer(self.msg, dtype=np.uint8)
+            image.reshape(-1)[self.offset:self.offset + delta.size] = delta
+            carrier_codecs.STATS.add('delta', decoded=1, decode_seconds=time.perf_counter() - start)
+            return image
+        if not self.codec:
+            return self.msg  # sent as a pickled array
+        return carrier_codecs.decode(self.msg, self.codec)
+
+    def __str__(self):
+        out = 'Name : '
+        out += self.name
+        out += ' Port :'
+        out += str(self.port)
+        return out
+
+
+class Outgoing:
+    # A carrier message serialized at most once per wire form, then shared by every recipient.
+    # Peers that hold the base carrier get a delta against it, the others the full image.
+
+    def __init__(self, msg, carrier, base=None, base_id=''):
+        self.msg = msg
+        self.image = carrier
+        self.base = base  # unmodified carrier the image was encoded into
+        self.base_id = base_id
+        self.frames = {}  # framed bytes, indexed by codec, or by 'delta'
+        self.lock = threading.Lock()
+
+    def frame(self, codec, carriers=()):  # carriers: ids of the carriers the recipient holds
+        key = 'delta' if self.base_id and self.base_id in carriers else codec
+        with self.lock:
+            data = self.frames.get(key)
+            if data is None:
+                msg = copy.copy(self.msg)
+                if msg.trace is not None:
+                    msg.trace = tracing.extend(msg.trace, 'framing')
+                if key == 'delta':
+                    msg.set_delta(self.image, self.base, self.base_id)
+                else:
+                    msg.set_carrier(self.image, codec)
+                data = self.frames[key] = pack(msg)
+            return data
+
+
+def frame(payload, type=FRAME_MSG):
+    return HEADER.pack(VERSION, type, 0, len(payload)) + payload
+
+
+def is_frame(data):  # True when data holds exactly one whole frame
+    if len(data) < HEADER.size:
+        return False
+    version, type, reserved, length = HEADER.unpack_from(data)
+    return version == VERSION and length <= MAX_FRAME and len(data) == HEADER.size + length
+
+
+def pack(msg):  # Frame ready to be written on a socket
+    return frame(pickle.dumps(msg, pickle.HIGHEST_PROTOCOL))
+
+
+def unpack(payload):
+    return pickle.loads(payload)
+
+
+class FrameReader:
+    # Incremental reassembler, one per connection. Bytes can be fed in any chunking,
+    # complete frames come out as (type, payload). The payload buffer is allocated once
+    # from the header length and filled in place, so large carriers never get concatenated.
+
+    def __init__(self, max_length=MAX_FRAME):
+        self.max_length = max_length
+        self.header = bytearray(HEADER.size)
+        self.type = None
+        self.payload = None  # payload being filled, None while reading a header
+        self.got = 0  # bytes already in header or payload
+
+    def start_payload(self):
+        version, type, reserved, length = HEADER.unpack(self.header)
+        if version != VERSION:
+            raise ProtocolError('Unsupported protocol version ' + str(version))
+        if length > self.max_length:
+            raise ProtocolError('Frame too large ' + str(length))
+        self.type = type
+        self.payload = bytearray(length)
+        self.got = 0
+
+    def finish_payload(self):
+        done = (self.type, self.payload)
+        self.type = None
+        self.payload = None
+        self.got = 0
+        return done
+
+    def feed(self, data):  # Returns the list of frames completed by data
+        frames = []
+        view = memoryview(data)
+        while True:
+            if self.payload is None:
+                if not view:
+                    break
+                take = min(HEADER.size - self.got, len(view))
+                self.header[self.got:self.got + take] = view[:take]
+                self.got += take
+                view = view[take:]
+                if self.got < HEADER.size:
+                    break
+                self.start_payload()
+            take = min(len(self.payload) - self.got, len(view))
+            self.payload[self.got:self.got + take] = view[:take]
+            self.got += take
+            view = view[take:]
+            if self.got < len(self.payload):
+                break
+            frames.append(self.finish_payload())
+        return frames
+
+    def recv(self, sock, bufsize=RECV_SIZE):
+        # Read once from sock. Returns the completed frames, None when the peer closed.
+        if self.payload is not None:
+            # In the middle of a payload, let the kernel copy straight into it
+            n = sock.recv_into(memoryview(self.payload)[self.got:])
+            if n == 0:
+                return None
+            self.got += n
+            if self.got < len(self.payload):
+                return []
+            return [self.finish_payload()]
+        data = sock.recv(bufsize)
+        if data == b'':
+            return None
+        return self.feed(data)
@@ -0,0 +1,129 @@
+#! /usr/bin/env python
+
+import hashlib
+import os
+import protocol
+
+BATCH_SIZE = 256 * 1024  # bytes of backlog read from disk and handed to a connection at once
+MAX_BACKLOG = 64 * 1024 * 1024  # refuse to queue more than this for one user
+
+
+class RelayQueue:
+    # Messages held for offline users, one append-only log of frames per user, stored as
+    # they go on the wire. A backlog is sent a batch at a time, the next one is read once
+    # the previous one left, so its size does not matter. How far a log was delivered is
+    # kept next to it, a login cut short resumes where it stopped.
+
+    def __init__(self, path, max_backlog=MAX_BACKLOG, batch_size=BATCH_SIZE):
+        self.path = path
+        self.max_backlog = max_backlog
+        self.batch_size = batch_size
+        self.draining = {}  # connection the backlog is being sent on, indexed by username
+        self.queued = 0
+        self.delivered = 0
+        os.makedirs(path, exist_ok=True)
+
+    def log_path(self, name):  # Usernames can hold anything, the file is named after their hash
+        return os.path.join(self.path, hashlib.sha256(name.encode('utf-8')).hexdigest()[:32] + '.log')
+
+    def pending(self, name):
+        return os.path.exists(self.log_path(name))
+
+    def append(self, name, data):  # Queue one frame for name, False when the backlog is full
+        path = self.log_path(name)
+        try:
+            size = os.path.getsize(path)
+        except OSError:
+            size = 0
+        if size + len(data) > self.max_backlog:
+            return False
+        with open(path, 'ab') as file:
+            file.write(data)
+            file.flush()
+            os.fsync(file.fileno())  # on disk before the sender is told it was queued
+        self.queued += 1
+        return True
+
+    def position(self, name):
+        try:
+            with open(self.log_path(name) + '.pos') as file:
+                return int(file.read())
+        except (OSError, ValueError):
+            return 0
+
+    def save_position(self, name, pos):
+        tmp = self.log_path(name) + '.tmp'
+        with open(tmp, 'w') as file:
+            file.write(str(pos))
+        os.replace(tmp, self.log_path(name) + '.pos')
+
+    def read_batch(self, name, pos):  # (whole frames starting at pos, position after them)
+        with open(self.log_path(name), 'rb') as file:
+            file.seek(pos)
+            data = file.read(self.batch_size)
+            end = 0
+            while end + protocol.HEADER.size <= len(data):
+                version, type, reserved, length = protocol.HEADER.unpack_from(data, end)
+                if version != protocol.VERSION or length > protocol.MAX_FRAME:
+                    raise protocol.ProtocolError('Corrupted relay log for ' + name)
+                if end + protocol.HEADER.size + length > len(data):
+                    if end == 0:  # a single frame bigger than a batch, read it whole
+                        file.seek(pos)
+                        data = file.read(protocol.HEADER.size + length)
+                        end = len(data)
+                    break
+                end += protocol.HEADER.size + length
+            return data[:end], pos + end
+
+    def remove(self, name):
+        for path in (self.log_path(name), self.log_path(name) + '.pos'):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def is_draining(self, name):  # New messages must queue behind the backlog to keep their order
+        return name in self.draining
+
+    def drain(self, name, conn, on_done=None):
+        # Send the backlog of name on conn a batch at a time, from the loop thread.
+        # on_done(count) runs once the whole log went out, count is the frames sent.
+        self.draining[name] = conn
+        state = {'pos': self.position(name), 'count': 0}
+
+        def next_batch(error=None):
+            if self.draining.get(name) is not conn:
+                return
+            if error is not None:  # connection lost, the rest waits for the next login
+                del self.draining[name]
+                return
+            try:
+                self.save_position(name, state['pos'])
+                data, pos = self.read_batch(name, state['pos'])
+            except (OSError, protocol.ProtocolError) as e:
+                print('Relay log of', name, 'dropped:', e)
+                data = b''
+            if not data:
+                del self.draining[name]
+                self.remove(name)
+                if on_done is not None:
+                    on_done(state['count'])
+                return
+            if len(data) > conn.max_buffer:  # a single frame the connection would be closed for, it never fits
+                print('Relayed message to', name, 'dropped,', len(data), 'bytes is more than its connection takes')
+                state['pos'] = pos
+                conn.loop.call_soon(next_batch)
+                return
+            frames = 0
+            offset = 0
+            while offset < len(data):
+                offset += protocol.HEADER.size + protocol.HEADER.unpack_from(data, offset)[3]
+                frames += 1
+            state['pos'] = pos
+            state['count'] += frames
+            self.delivered += frames
+            conn.send(data, lambda error: conn.loop.call_soon(next_batch, error))  # no recursion when the kernel takes it at once
+        next_batch()
+
+    def stats(self):
+        return {'queued': self.queued, 'delivered': self.delivered, 'draining': len(self.draining)}
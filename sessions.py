@@ -0,0 +1,163 @@
+#! /usr/bin/env python
+
+import hashlib
+import os
+import threading
+import time
+from Crypto.Cipher import AES
+from Crypto.Hash import SHA256
+from Crypto.Protocol.DH import import_x25519_public_key, key_agreement
+from Crypto.Protocol.KDF import HKDF
+from Crypto.PublicKey import ECC
+import metrics
+
+# Encryption of what peers hide in their carriers.
+#
+# Two peers agree on a session key once, with an X25519 exchange carried by the HELLO
+# messages of their connection, and keep it for SESSION_TTL. Each message is then
+# encrypted once with AES-GCM under a fresh message key, and that message key is
+# wrapped under the session key of every recipient, so a public message is still
+# encrypted and hidden only once for everybody. No public key operation happens per
+# message.
+#
+# The exchange is not authenticated: it keeps what is hidden away from anybody who
+# only sees the carriers, not from a peer lying about its name.
+
+SESSION_TTL = 3600  # seconds a session key is used for new messages before the peers agree on a new one
+KEEP_OLD = 600  # seconds an expired key still opens messages sealed just before it expired
+KEY_SIZE = 32  # AES-256
+INFO = b'steg-chat session key'
+METRICS = metrics.Registry('session_crypto')
+
+
+class SessionError(Exception):
+    pass
+
+
+def key_id(key):  # Short public name of a session key, the same on both sides
+    return hashlib.sha256(key).hexdigest()[:16]
+
+
+class Handshake:
+    # Our half of one key exchange. public is sent to the peer, finish() takes theirs.
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.key = ECC.generate(curve='curve25519')
+        self.public = self.key.public_key().export_key(format='raw')
+
+    def finish(self, peer_public, initiator):
+        # initiator: True on the side that sent its public key first, both sides must
+        # feed the two keys to the KDF in the same order
+        first, second = (self.public, peer_public) if initiator else (peer_public, self.public)
+        try:
+            session = key_agreement(static_priv=self.key, static_pub=import_x25519_public_key(bytes(peer_public)),
+                                    kdf=lambda secret: HKDF(secret, KEY_SIZE, first + second, SHA256, context=INFO))
+        except ValueError as e:
+            raise SessionError('Bad key exchange: %s' % e)
+        METRICS.inc('handshakes_total')
+        METRICS.observe('handshake_seconds', time.perf_counter() - self.start)
+        return session
+
+
+class SessionCache:
+    # Session keys indexed by peer name. The newest one of a peer seals what we send it
+    # until it expires, older ones open what is still on its way for a while after.
+
+    def __init__(self, ttl=SESSION_TTL, keep=KEEP_OLD):
+        self.ttl = ttl
+        self.keep = keep
+        self.lock = threading.Lock()
+        self.keys = {}  # (key, created), indexed by peer then by key id
+        self.current = {}  # key id sealing new messages, indexed by peer
+
+    def put(self, peer, key):
+        now = time.monotonic()
+        kid = key_id(key)
+        with self.lock:
+            self.keys.setdefault(peer, {})[kid] = (key, now)
+            self.current[peer] = kid
+            self.expire(peer, now)
+        return kid
+
+    def expire(self, peer, now):  # Lock held
+        keys = self.keys.get(peer, {})
+        for kid, (key, created) in list(keys.items()):
+            if now - created > self.ttl + self.keep:
+                del keys[kid]
+                if self.current.get(peer) == kid:
+                    del self.current[peer]
+        if not keys:
+            self.keys.pop(peer, None)
+
+    def session(self, peer):  # (key id, key) to seal messages to peer, None when a handshake is due
+        now = time.monotonic()
+        with self.lock:
+            self.expire(peer, now)
+            kid = self.current.get(peer)
+            if kid is None:
+                return None
+            key, created = self.keys[peer][kid]
+            if now - created > self.ttl:
+                return None
+            return kid, key
+
+    def find(self, peer, kid):  # Key to open a message from peer, None when unknown or expired
+        now = time.monotonic()
+        with self.lock:
+            self.expire(peer, now)
+            entry = self.keys.get(peer, {}).get(kid)
+            return entry[0] if entry is not None else None
+
+    def forget(self, peer):  # peer logged out, whatever comes back under its name has none of these keys
+        with self.lock:
+            self.keys.pop(peer, None)
+            self.current.pop(peer, None)
+
+    def stats(self):
+        with self.lock:
+            return {'peers': len(self.keys), 'keys': sum(len(keys) for keys in self.keys.values())}
+
+
+def seal(data, sessions):
+    # Encrypt data once for every recipient in sessions ({name: (key id, key)}). Returns
+    # (ciphertext, envelope), the ciphertext is what gets hidden and the envelope travels
+    # in the Msg: the nonce and tag of the payload and the message key wrapped per recipient.
+    start = time.perf_counter()
+    message_key = os.urandom(KEY_SIZE)
+    cipher = AES.new(message_key, AES.MODE_GCM)
+    ciphertext, tag = cipher.encrypt_and_digest(data)
+    keys = {}
+    for name, (kid, key) in sessions.items():
+        wrap = AES.new(key, AES.MODE_GCM)
+        wrapped, wrap_tag = wrap.encrypt_and_digest(message_key)
+        keys[name] = (kid, wrap.nonce, wrapped + wrap_tag)
+    METRICS.inc('sealed_total')
+    METRICS.inc('sealed_bytes_total', len(data))
+    METRICS.observe('seal_seconds', time.perf_counter() - start)
+    return ciphertext, {'nonce': cipher.nonce, 'tag': tag, 'keys': keys}
+
+
+def open_sealed(ciphertext, envelope, me, sender, cache):  # Plaintext of a message sealed by sender
+    start = time.perf_counter()
+    try:
+        entry = envelope['keys'].get(me)
+        if entry is None:
+            raise SessionError('Message from ' + sender + ' is not encrypted for us')
+        kid, nonce, wrapped = entry
+        key = cache.find(sender, kid)
+        if key is None:
+            raise SessionError('No session key with ' + sender + ' to open its message')
+        try:
+            message_key = AES.new(key, AES.MODE_GCM, nonce=nonce).decrypt_and_verify(wrapped[:-16], wrapped[-16:])
+            data = AES.new(message_key, AES.MODE_GCM, nonce=envelope['nonce']).decrypt_and_verify(
+                bytes(ciphertext), envelope['tag'])
+        except ValueError:
+            raise SessionError('Message from ' + sender + ' failed authentication')
+    except SessionError:
+        METRICS.inc('open_failures_total')
+        raise
+    METRICS.inc('opened_total')
+    METRICS.inc('opened_bytes_total', len(data))
+    METRICS.observe('open_seconds', time.perf_counter() - start)
+    return data
@@ -0,0 +1,102 @@
+#! /usr/bin/env python
+
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+# Steganography off the event loop. Hiding and recovering payloads is NumPy bulk work
+# (bit unpacking, masking, packing, codec decompression) that releases the GIL, so a
+# few worker threads spread a burst of carriers over the cores while the loop keeps
+# serving sockets. A thread pool rather than processes: carriers are shared read-only
+# between threads, with processes every job would pickle a whole image both ways.
+
+WORKERS = os.cpu_count() or 1
+MAX_PENDING = 64  # jobs queued or running before submitters are held back
+
+
+class StegPool:
+    # Jobs submitted under the same key (a sender) may run at the same time, but their
+    # done callbacks run on the loop in submission order, so the messages of one peer are
+    # shown and written in the order they arrived.
+
+    def __init__(self, loop, workers=WORKERS, max_pending=MAX_PENDING):
+        self.loop = loop
+        self.workers = workers
+        self.max_pending = max_pending
+        self.executor = ThreadPoolExecutor(workers, thread_name_prefix='steg')
+        self.room = threading.Condition()
+        self.pending = 0  # jobs queued or running
+        self.chains = {}  # deque of [future, done] waiting for their turn, indexed by key, loop thread only
+        self.held = set()  # connections not read from until the queue has room again, loop thread only
+        self.jobs = 0
+        self.busy_seconds = 0.0
+        self.peak = 0
+
+    def full(self):
+        return self.pending >= self.max_pending
+
+    def execute(self, work, args):
+        start = time.perf_counter()
+        try:
+            return work(*args)
+        finally:
+            with self.room:
+                self.busy_seconds += time.perf_counter() - start
+
+    def enqueue(self, work, args):
+        with self.room:
+            self.pending += 1
+            self.jobs += 1
+            self.peak = max(self.peak, self.pending)
+        future = self.executor.submit(self.execute, work, args)
+        future.add_done_callback(self.finished)
+        return future
+
+    def finished(self, future):
+        with self.room:
+            self.pending -= 1
+            self.room.notify()
+
+    def submit(self, key, work, args, done, source=None):
+        # Loop thread only, never blocks. work(*args) runs on a worker, then done(result, error)
+        # on the loop once every earlier job of key is done. source is the eventloop.Connection
+        # the job came from, it stops being read while the queue is full.
+        future = self.enqueue(work, args)
+        entry = [future, done]
+        chain = self.chains.get(key)
+        if chain is None:
+            chain = self.chains[key] = deque()
+        chain.append(entry)
+        future.add_done_callback(lambda future: self.loop.call_soon_threadsafe(self.release, key))
+        if source is not None and self.full() and not source.closed and not source.held:
+            source.hold(True)
+            self.held.add(source)
+
+    def release(self, key):  # Hand the finished jobs at the head of key's chain to their callbacks
+        chain = self.chains.get(key)
+        while chain and chain[0][0].done():
+            future, done = chain.popleft()
+            error = future.exception()
+            done(None if error is not None else future.result(), error)
+        if chain is not None and not chain:
+            del self.chains[key]
+        if self.held and not self.full():
+            for conn in self.held:
+                if not conn.closed:
+                    conn.hold(False)
+            self.held.clear()
+
+    def run(self, work, *args):
+        # From any thread but the loop's: wait while the queue is full, then run work(*args)
+        # on a worker. Returns its Future.
+        with self.room:
+            while self.full():
+                self.room.wait()
+        return self.enqueue(work, args)
+
+    def stats(self):
+        with self.room:
+            return {'workers': self.workers, 'pending': self.pending, 'peak': self.peak, 'jobs': self.jobs,
+                    'busy_seconds': round(self.busy_seconds, 3)}
@@ -0,0 +1,78 @@
+#! /usr/bin/env python
+
+import json
+import os
+import threading
+import time
+import uuid
+from collections import deque
+
+# Per-message tracing. A traced Msg carries {'id': ..., 'stages': [(stage, time), ...]},
+# every step of the pipeline appends its stage, and the receiver turns consecutive
+# stamps into stage durations. Untraced messages carry None and skip all of it.
+#
+# Stamps come from the wall clock: the sender and the receiver are different processes,
+# possibly on different machines, and only the wall clock means the same thing on both.
+
+ENABLED = os.environ.get('STEG_TRACE', '') not in ('', '0')  # start traces for the messages we send
+LOG_PATH = os.environ.get('STEG_TRACE_LOG', '')  # every finished trace is appended here as a JSON line
+WINDOW = 1024  # durations kept per stage for the percentiles
+
+
+def clock():
+    return time.time()
+
+
+def start():  # New trace for a message about to be built, None when tracing is off
+    if not ENABLED:
+        return None
+    return {'id': uuid.uuid4().hex[:16], 'stages': [('start', clock())]}
+
+
+def stamp(trace, stage, when=None):
+    if trace is not None:
+        trace['stages'].append((stage, clock() if when is None else when))
+
+
+def extend(trace, stage):  # Copy of trace with one more stage, for a message serialized in several forms
+    return {'id': trace['id'], 'stages': trace['stages'] + [(stage, clock())]}
+
+
+class TraceLog:
+    # Rolling percentiles of the stage durations of the traces seen by this process,
+    # plus an optional JSON lines log of every trace for offline analysis.
+
+    def __init__(self, window=WINDOW, path=LOG_PATH):
+        self.window = window
+        self.path = path
+        self.lock = threading.Lock()
+        self.durations = {}  # last window durations in seconds, indexed by stage
+        self.traces = 0
+
+    def record(self, trace, **info):  # info: where the trace ended, written to the log with it
+        stages = trace['stages']
+        with self.lock:
+            self.traces += 1
+            for (_, before), (stage, after) in zip(stages, stages[1:]):
+                self.durations.setdefault(stage, deque(maxlen=self.window)).append(after - before)
+            if len(stages) > 1 and stages[0][0] == 'start':  # the whole trip, not just our side of it
+                self.durations.setdefault('total', deque(maxlen=self.window)).append(stages[-1][1] - stages[0][1])
+            if self.path:
+                entry = dict(info)
+                entry['id'] = trace['id']
+                entry['stages'] = stages
+                with open(self.path, 'a') as file:
+                    file.write(json.dumps(entry) + '\n')
+
+    def summary(self):  # {stage: {'count', 'p50_ms', 'p90_ms', 'p99_ms'}} over the window
+        with self.lock:
+            out = {}
+            for stage, values in self.durations.items():
+                ordered = sorted(values)
+                out[stage] = {'count': len(ordered)}
+                for p in (50, 90, 99):
+                    out[stage]['p%d_ms' % p] = round(ordered[min(len(ordered) - 1, len(ordered) * p // 100)] * 1000, 3)
+            return out
+
+
+TRACES = TraceLog()
@@ -0,0 +1,104 @@
+#! /usr/bin/env python
+
+import hashlib
+import hmac
+import os
+import sqlite3
+import threading
+import time
+
+HASH_NAME = 'sha256'
+HASH_ITERATIONS = 100000  # PBKDF2 rounds for new passwords, stored per user so it can be raised later
+SALT_SIZE = 16
+DUMMY_SALT = os.urandom(SALT_SIZE)  # hashed against for unknown names, a failed login takes as long either way
+
+
+class UserStore:
+    # Registered accounts in SQLite, looked up through the primary key, so opening the
+    # store takes the same time for ten accounts or a million. Registrations are committed
+    # before the OK. Only a salted PBKDF2 hash of each password is kept.
+
+    def __init__(self, path):
+        start = time.perf_counter()
+        self.path = path
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, isolation_level=None, check_same_thread=False)  # autocommit
+        self.db.execute('PRAGMA journal_mode=WAL')  # appends, readers never wait for a registration
+        self.db.execute('PRAGMA synchronous=FULL')  # fsync every commit
+        self.db.execute('CREATE TABLE IF NOT EXISTS users ('
+                        'name TEXT PRIMARY KEY, salt BLOB NOT NULL, hash BLOB NOT NULL, '
+                        'iterations INTEGER NOT NULL, pub_key TEXT NOT NULL DEFAULT \'\') WITHOUT ROWID')
+        self.load_seconds = time.perf_counter() - start
+        self.registrations = 0
+        self.logins = 0
+        self.failed_logins = 0
+
+    def exists(self, name):
+        with self.lock:
+            return self.db.execute('SELECT 1 FROM users WHERE name = ?', (name,)).fetchone() is not None
+
+    def empty(self):
+        with self.lock:
+            return self.db.execute('SELECT 1 FROM users LIMIT 1').fetchone() is None
+
+    def add(self, name, password, pub_key=''):  # False when the name is already taken
+        salt = os.urandom(SALT_SIZE)
+        digest = hash_password(password, salt, HASH_ITERATIONS)
+        try:
+            with self.lock:
+                self.db.execute('INSERT INTO users (name, salt, hash, iterations, pub_key) VALUES (?, ?, ?, ?, ?)',
+                                (name, salt, digest, HASH_ITERATIONS, pub_key))
+        except sqlite3.IntegrityError:
+            return False
+        with self.lock:
+            self.registrations += 1
+        return True
+
+    def check(self, name, password):  # True when name exists and password matches
+        with self.lock:
+            row = self.db.execute('SELECT salt, hash, iterations FROM users WHERE name = ?', (name,)).fetchone()
+        if row is None:
+            hash_password(password, DUMMY_SALT, HASH_ITERATIONS)
+            matches = False
+        else:
+            matches = hmac.compare_digest(hash_password(password, row[0], row[2]), row[1])
+        with self.lock:
+            if matches:
+                self.logins += 1
+            else:
+                self.failed_logins += 1
+        return matches
+
+    def import_users(self, users):  # (name, password) pairs, written in a single transaction
+        rows = []
+        for name, password in users:
+            salt = os.urandom(SALT_SIZE)
+            rows.append((name, salt, hash_password(password, salt, HASH_ITERATIONS), HASH_ITERATIONS))
+        with self.lock:
+            self.db.execute('BEGIN')
+            try:
+                self.db.executemany('INSERT OR IGNORE INTO users (name, salt, hash, iterations) VALUES (?, ?, ?, ?)',
+                                    rows)
+                self.db.execute('COMMIT')
+            except Exception:
+                self.db.execute('ROLLBACK')
+                raise
+        return len(rows)
+
+    def count(self):  # Walks the whole index, keep it off the login path
+        with self.lock:
+            return self.db.execute('SELECT COUNT(*) FROM users').fetchone()[0]
+
+    def stats(self):
+        return {'load_seconds': self.load_seconds, 'registrations': self.registrations,
+                'logins': self.logins, 'failed_logins': self.failed_logins}
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+
+def hash_password(password, salt, iterations):
+    if isinstance(password, str):
+        password = password.encode('utf-8')
+    return hashlib.pbkdf2_hmac(HASH_NAME, password, salt, iterations)